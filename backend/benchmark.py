@@ -0,0 +1,345 @@
+"""
+Offline benchmark / load test for the backend.
+
+Starts local stand-ins for the outside world (a fake Terabox mirror serving share pages
+and the share/list API, and a throttled, range-capable media origin), runs the app in a
+uvicorn subprocess pointed at them, then drives it under concurrent load:
+
+  1. resolve:  POST /api/resolve for distinct shares  -> latency p50/p99
+  2. download: GET /api/download/{fileId}              -> TTFB, per-download and total throughput
+
+and reports the app's memory high-water mark. Nothing leaves the machine, so runs are
+comparable across commits (use --json to keep the numbers):
+
+    python benchmark.py --resolves 200 --downloads 16 --concurrency 16 --json bench.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import aiohttp
+from aiohttp import web
+
+JS_TOKEN = "9F3A0C51E7B2D48A"
+CHUNK = 64 * 1024
+
+
+# Stand-ins
+
+class FakeTerabox:
+    """Share page (jsToken + empty yunData, like pages that load the list via XHR) and share/list API."""
+
+    def __init__(self, origin, file_size, distinct_files, latency):
+        self.origin = origin
+        self.file_size = file_size
+        self.distinct_files = distinct_files
+        self.latency = latency
+
+    async def share_page(self, request):
+        await asyncio.sleep(self.latency)
+        html = ("<html><head><title>Bench - Share Files Online</title></head><body>"
+                f'<script>var jsToken = decodeURIComponent(fn("{JS_TOKEN}"));'
+                'window.yunData = {"FILEINFO": []};</script></body></html>')
+        return web.Response(text=html, content_type="text/html")
+
+    async def share_list(self, request):
+        await asyncio.sleep(self.latency)
+        if request.query.get("jsToken") != JS_TOKEN:
+            return web.json_response({"errno": 4000})
+        surl = request.query["shorturl"]
+        fid = int(surl.rsplit("-", 1)[-1]) % self.distinct_files
+        info = {
+            "server_filename": f"bench-{fid}.mp4",
+            "size": self.file_size,
+            "isdir": 0,
+            "path": f"/bench-{fid}.mp4",
+            "fs_id": fid,
+            # A fresh signature per resolve, like the real dlinks
+            "dlink": f"{self.origin}/file/bench-{fid}?fid={fid}&sign={os.urandom(6).hex()}"
+                     f"&time={int(time.time())}&expires=8h",
+        }
+        return web.json_response({"errno": 0, "list": [info]})
+
+
+class MediaOrigin:
+    """Serves one random blob under any fid, honouring single ranges, throttled per connection."""
+
+    def __init__(self, file_size, rate):
+        self.data = os.urandom(file_size)
+        self.rate = rate
+        self.requests = 0
+        self.bytes = 0
+
+    async def file(self, request):
+        self.requests += 1
+        size = len(self.data)
+        start, end, status = 0, size - 1, 200
+        header = request.headers.get("Range", "")
+        if header.startswith("bytes="):
+            first, _, last = header[6:].partition("-")
+            start = int(first or 0)
+            end = min(int(last), size - 1) if last else size - 1
+            status = 206
+        resp = web.StreamResponse(status=status)
+        resp.headers["Accept-Ranges"] = "bytes"
+        resp.headers["ETag"] = '"bench"'
+        resp.content_length = end - start + 1
+        if status == 206:
+            resp.headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        await resp.prepare(request)
+        view = memoryview(self.data)
+        sent_at = time.monotonic()
+        for offset in range(start, end + 1, CHUNK):
+            chunk = view[offset:min(offset + CHUNK, end + 1)]
+            try:
+                await resp.write(chunk)
+            except ConnectionError:
+                # The proxy drops the first connection once segments take over (reset or broken pipe)
+                return resp
+            self.bytes += len(chunk)
+            if self.rate:
+                # Throttle to `rate` bytes/s on this connection
+                sent_at += len(chunk) / self.rate
+                delay = sent_at - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+        return resp
+
+
+async def start_site(routes):
+    app = web.Application()
+    app.add_routes(routes)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+    return runner, f"{host}:{port}"
+
+
+# App under test
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_app(port, mirror, workdir, extra_env, verbose=False):
+    env = {
+        **os.environ,
+        "TERABOX_MIRRORS": mirror,
+        "STATE_BACKEND": "local",
+        "COOKIE_FILE": os.path.join(workdir, "cookies.json"),
+        "PROXY_CACHE_DIR": os.path.join(workdir, "proxy_cache"),
+        "PREWARM": "0",
+        **extra_env,
+    }
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--log-level", "warning", "--no-access-log"],
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+        stdout=None if verbose else subprocess.DEVNULL,
+    )
+
+
+async def wait_ready(session, base, proc, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"App exited with code {proc.returncode}")
+        try:
+            async with session.get(f"{base}/api/ready") as resp:
+                if resp.status == 200:
+                    return
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError("App did not become ready")
+
+
+def memory_high_water(pid):
+    """Peak resident memory of a process in bytes (Linux), or None."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+# Load
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+async def run_concurrently(count, concurrency, work):
+    slots = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        async with slots:
+            return await work(i)
+
+    return await asyncio.gather(*(one(i) for i in range(count)))
+
+
+async def bench_resolves(session, base, count, concurrency, run_id):
+    async def resolve(i):
+        started = time.perf_counter()
+        try:
+            async with session.post(f"{base}/api/resolve", json={"url": f"http://terabox.com/s/1{run_id}-{i}"}) as resp:
+                payload = await resp.json()
+        except Exception as e:
+            return time.perf_counter() - started, None, str(e)
+        elapsed = time.perf_counter() - started
+        return elapsed, payload.get("fileId"), None if payload.get("success") else payload.get("error")
+
+    started = time.perf_counter()
+    results = await run_concurrently(count, concurrency, resolve)
+    wall = time.perf_counter() - started
+    latencies = [r[0] for r in results if not r[2]]
+    errors = [r[2] for r in results if r[2]]
+    return {
+        "count": count,
+        "errors": len(errors),
+        "first_error": errors[0] if errors else None,
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 1) if latencies else None,
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 1) if latencies else None,
+        "mean_ms": round(sum(latencies) / len(latencies) * 1000, 1) if latencies else None,
+        "per_second": round(len(latencies) / wall, 1),
+    }, [r[1] for r in results if r[1]]
+
+
+async def bench_downloads(session, base, file_ids, concurrency, expected_size):
+    async def download(i):
+        file_id = file_ids[i % len(file_ids)]
+        started = time.perf_counter()
+        ttfb = None
+        size = 0
+        try:
+            async with session.get(f"{base}/api/download/{file_id}") as resp:
+                if resp.status != 200:
+                    return None, None, 0, f"status {resp.status}"
+                async for chunk in resp.content.iter_chunked(CHUNK):
+                    if ttfb is None:
+                        ttfb = time.perf_counter() - started
+                    size += len(chunk)
+        except Exception as e:
+            return None, None, size, str(e)
+        elapsed = time.perf_counter() - started
+        error = None if size == expected_size else f"short body ({size} of {expected_size})"
+        return ttfb, elapsed, size, error
+
+    started = time.perf_counter()
+    results = await run_concurrently(len(file_ids), concurrency, download)
+    wall = time.perf_counter() - started
+    ok = [r for r in results if not r[3]]
+    errors = [r[3] for r in results if r[3]]
+    ttfbs = [r[0] for r in ok]
+    rates = [r[2] / r[1] for r in ok if r[1]]
+    total = sum(r[2] for r in results)
+    return {
+        "count": len(file_ids),
+        "errors": len(errors),
+        "first_error": errors[0] if errors else None,
+        "ttfb_p50_ms": round(percentile(ttfbs, 0.5) * 1000, 1) if ttfbs else None,
+        "ttfb_p99_ms": round(percentile(ttfbs, 0.99) * 1000, 1) if ttfbs else None,
+        "per_download_mib_s_p50": round(percentile(rates, 0.5) / 2 ** 20, 1) if rates else None,
+        "total_mib_s": round(total / wall / 2 ** 20, 1),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+async def main(args):
+    origin = MediaOrigin(args.size * 2 ** 20, args.origin_rate * 2 ** 20)
+    origin_runner, origin_addr = await start_site([web.get("/file/{name}", origin.file)])
+    terabox = FakeTerabox(f"http://{origin_addr}", len(origin.data), args.distinct_files or args.downloads,
+                          args.latency / 1000)
+    terabox_runner, terabox_addr = await start_site([
+        web.get("/s/{surl}", terabox.share_page),
+        web.get("/share/list", terabox.share_list),
+    ])
+
+    port = free_port()
+    base = f"http://127.0.0.1:{port}"
+    extra_env = dict(kv.split("=", 1) for kv in args.env)
+    with tempfile.TemporaryDirectory() as workdir:
+        proc = start_app(port, terabox_addr, workdir, extra_env, args.verbose)
+        try:
+            timeout = aiohttp.ClientTimeout(total=None, sock_read=120)
+            connector = aiohttp.TCPConnector(limit=0)
+            async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+                await wait_ready(session, base, proc)
+                run_id = os.urandom(3).hex()
+
+                print(f"Resolving {args.resolves} shares ({args.concurrency} concurrent)...")
+                resolves, file_ids = await bench_resolves(session, base, args.resolves, args.concurrency, run_id)
+
+                downloads = None
+                if args.downloads and file_ids:
+                    # One fileId per share; --distinct-files below --downloads makes shares point at the same file
+                    ids = file_ids[:args.downloads]
+                    if len(ids) < args.downloads:
+                        _, extra = await bench_resolves(session, base, args.downloads - len(ids),
+                                                        args.concurrency, run_id + "x")
+                        ids += extra
+                    print(f"Downloading {len(ids)} x {args.size} MiB ({args.concurrency} concurrent)...")
+                    downloads = await bench_downloads(session, base, ids, args.concurrency, len(origin.data))
+
+                peak = memory_high_water(proc.pid)
+        finally:
+            proc.terminate()
+            try:
+                proc.wait(10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+            await terabox_runner.cleanup()
+            await origin_runner.cleanup()
+
+    report = {
+        "revision": git_revision(),
+        "config": {k: v for k, v in vars(args).items() if k not in ("json", "verbose")},
+        "resolve": resolves,
+        "download": downloads,
+        "origin": {"requests": origin.requests, "mib_sent": round(origin.bytes / 2 ** 20, 1)},
+        "memory_high_water_mib": round(peak / 2 ** 20, 1) if peak else None,
+    }
+    print(json.dumps(report, indent=2))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline benchmark against local Terabox/CDN stand-ins")
+    parser.add_argument("--resolves", type=int, default=100, help="Distinct shares to resolve")
+    parser.add_argument("--downloads", type=int, default=8, help="Proxied downloads (0 skips the phase)")
+    parser.add_argument("--concurrency", type=int, default=8, help="Requests in flight at once")
+    parser.add_argument("--size", type=int, default=32, help="File size in MiB")
+    parser.add_argument("--origin-rate", type=float, default=16, help="Origin MiB/s per connection (0: unthrottled)")
+    parser.add_argument("--latency", type=float, default=50, help="Share page / API latency in ms")
+    parser.add_argument("--distinct-files", type=int, default=0,
+                        help="Distinct files behind the shares (default: one per download)")
+    parser.add_argument("--env", action="append", default=[], metavar="NAME=VALUE",
+                        help="Extra environment for the app, e.g. --env PROXY_CACHE=1")
+    parser.add_argument("--json", help="Also write the report to this file")
+    parser.add_argument("--verbose", action="store_true", help="Show the app's own output")
+    asyncio.run(main(parser.parse_args()))
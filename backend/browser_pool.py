@@ -0,0 +1,180 @@
+import asyncio
+import os
+from contextlib import asynccontextmanager
+from metrics import BROWSER_LAUNCH_SECONDS
+
+# Pool tuning (overridable from the environment)
+BROWSER_POOL_SIZE = int(os.environ.get("BROWSER_POOL_SIZE", "2"))
+BROWSER_MAX_PAGES = int(os.environ.get("BROWSER_MAX_PAGES", "50"))  # Recycle a browser after this many pages
+BROWSER_ACQUIRE_TIMEOUT = float(os.environ.get("BROWSER_ACQUIRE_TIMEOUT", "60"))
+
+# Stealth launch args shared by every pooled browser
+LAUNCH_ARGS = [
+    "--disable-blink-features=AutomationControlled",
+    "--no-sandbox",
+    "--disable-setuid-sandbox",
+    "--disable-dev-shm-usage",
+    "--disable-accelerated-2d-canvas",
+    "--no-first-run",
+    "--no-zygote",
+    "--disable-gpu",
+]
+
+
+class _Slot:
+    def __init__(self, index):
+        self.index = index
+        self.browser = None
+        self.pages = 0
+
+
+class BrowserPool:
+    """
+    Long-lived pool of pre-launched Chromium browsers.
+    Each checkout gets a fresh (cheap) context on a warm browser, so a resolve
+    only pays for page navigation instead of a full browser launch.
+    """
+
+    def __init__(self, size: int = BROWSER_POOL_SIZE, max_pages: int = BROWSER_MAX_PAGES):
+        self.size = max(1, size)
+        self.max_pages = max(1, max_pages)
+        self._playwright = None
+        self._slots = []
+        self._idle = None
+        self._lock = asyncio.Lock()
+        self._tasks = set()
+
+        # Stats
+        self.in_use = 0
+        self.launches = 0
+        self.recycles = 0
+        self.crashes = 0
+        self.pages_served = 0
+
+    @property
+    def started(self):
+        return self._playwright is not None
+
+    @property
+    def ready(self):
+        """True once at least one warm browser is up."""
+        return self.started and any(s.browser is not None and s.browser.is_connected() for s in self._slots)
+
+    async def start(self):
+        async with self._lock:
+            if self.started:
+                return
+            # Imported on first use: playwright is slow to import and most requests never need it
+            from playwright.async_api import async_playwright
+            self._playwright = await async_playwright().start()
+            self._idle = asyncio.Queue()
+            self._slots = [_Slot(i) for i in range(self.size)]
+
+            # Launch failures are tolerated here; the slot is relaunched on checkout.
+            results = await asyncio.gather(*(self._launch(s) for s in self._slots), return_exceptions=True)
+            for slot, result in zip(self._slots, results):
+                if isinstance(result, Exception):
+                    print(f"Browser pool: launch failed for slot {slot.index}: {result}")
+                self._idle.put_nowait(slot)
+            print(f"Browser pool started ({self.size} browsers, recycle after {self.max_pages} pages)")
+
+    async def stop(self):
+        async with self._lock:
+            if not self.started:
+                return
+            for slot in self._slots:
+                await self._close(slot)
+            await self._playwright.stop()
+            self._playwright = None
+            self._slots = []
+            self._idle = None
+            print("Browser pool stopped")
+
+    async def _launch(self, slot):
+        with BROWSER_LAUNCH_SECONDS.time():
+            slot.browser = await self._playwright.chromium.launch(headless=True, args=LAUNCH_ARGS)
+        slot.pages = 0
+        self.launches += 1
+
+    async def _close(self, slot):
+        browser, slot.browser = slot.browser, None
+        if browser:
+            try:
+                await browser.close()
+            except Exception:
+                pass
+
+    async def _replace(self, slot, idle):
+        # Relaunch in the background so the next checkout gets a warm browser
+        await self._close(slot)
+        try:
+            if self.started:
+                await self._launch(slot)
+        except Exception as e:
+            print(f"Browser pool: relaunch failed for slot {slot.index}: {e}")
+        idle.put_nowait(slot)
+
+    def _schedule_replace(self, slot, idle):
+        task = asyncio.create_task(self._replace(slot, idle))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    @asynccontextmanager
+    async def context(self, **options):
+        """
+        Checks out a warm browser and yields a new context created with `options`.
+        The context is closed on exit and the browser is recycled when it crashed
+        or has served `max_pages` pages.
+        """
+        if not self.started:
+            await self.start()
+
+        idle = self._idle
+        slot = await asyncio.wait_for(idle.get(), BROWSER_ACQUIRE_TIMEOUT)
+        self.in_use += 1
+        context = None
+        try:
+            if slot.browser is None or not slot.browser.is_connected():
+                if slot.browser is not None:
+                    self.crashes += 1
+                await self._close(slot)
+                await self._launch(slot)
+
+            context = await slot.browser.new_context(**options)
+            yield context
+        finally:
+            self.in_use -= 1
+            if context is not None:
+                try:
+                    await context.close()
+                except Exception:
+                    pass
+                slot.pages += 1
+                self.pages_served += 1
+
+            if slot.browser is not None and not slot.browser.is_connected():
+                self.crashes += 1
+                self._schedule_replace(slot, idle)
+            elif slot.browser is not None and slot.pages >= self.max_pages:
+                self.recycles += 1
+                self._schedule_replace(slot, idle)
+            else:
+                idle.put_nowait(slot)
+
+    def stats(self):
+        return {
+            "started": self.started,
+            "size": self.size,
+            "browsers": sum(1 for s in self._slots if s.browser is not None and s.browser.is_connected()),
+            "idle": self._idle.qsize() if self._idle else 0,
+            "in_use": self.in_use,
+            "max_pages_per_browser": self.max_pages,
+            "pages_served": self.pages_served,
+            "launches": self.launches,
+            "recycles": self.recycles,
+            "crashes": self.crashes,
+        }
+
+
+# Shared pool, started/stopped by the FastAPI app lifespan
+BROWSER_POOL = BrowserPool()
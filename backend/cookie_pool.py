@@ -0,0 +1,217 @@
+import asyncio
+import hashlib
+import os
+import time
+from collections import deque
+from state import STATE
+
+# Cookie pool tuning (overridable from the environment)
+COOKIE_QUARANTINE_LOGIN = float(os.environ.get("COOKIE_QUARANTINE_LOGIN", str(6 * 3600)))  # Logged-out accounts
+COOKIE_QUARANTINE_THROTTLE = float(os.environ.get("COOKIE_QUARANTINE_THROTTLE", "600"))  # Throttled accounts
+COOKIE_FAILURE_STREAK = int(os.environ.get("COOKIE_FAILURE_STREAK", "3"))  # Consecutive failures treated as throttling
+COOKIE_POOL_RETRIES = int(os.environ.get("COOKIE_POOL_RETRIES", "1"))  # Other accounts tried after a quarantine
+HEALTH_WINDOW = 20  # Recent outcomes an account's success rate is computed over
+RELOAD_INTERVAL = 60  # Seconds between re-reads of a shared state backend
+ACCOUNT_KEY = "cookie_pool:"  # State key prefix; one key per account so workers never overwrite each other
+
+THROTTLE_MARKERS = ["429", "too many", "rate limit", "frequent"]
+# Errors about the share itself, which say nothing about the account
+SHARE_ERROR_MARKERS = ["expired", "password", "not found", "(404)"]
+
+
+def cookie_id(cookie: str):
+    return hashlib.sha1(cookie.encode()).hexdigest()[:10]
+
+
+class CookieAccount:
+    __slots__ = ("id", "cookie", "label", "added_at", "quarantined_until", "quarantine_reason",
+                 "uses", "successes", "failures", "streak", "recent", "last_used", "last_error")
+
+    def __init__(self, cookie, label=None, added_at=None, quarantined_until=0.0, quarantine_reason=None):
+        self.id = cookie_id(cookie)
+        self.cookie = cookie
+        self.label = label
+        self.added_at = added_at or time.time()
+        self.quarantined_until = quarantined_until
+        self.quarantine_reason = quarantine_reason
+        self.uses = 0
+        self.successes = 0
+        self.failures = 0
+        self.streak = 0  # Consecutive failures
+        self.recent = deque(maxlen=HEALTH_WINDOW)
+        self.last_used = 0.0
+        self.last_error = None
+
+    @property
+    def success_rate(self):
+        # Untried accounts count as healthy so they get picked
+        return sum(self.recent) / len(self.recent) if self.recent else 1.0
+
+    def quarantined(self, now):
+        return self.quarantined_until > now
+
+    def to_record(self):
+        return {"cookie": self.cookie, "label": self.label, "added_at": self.added_at,
+                "quarantined_until": self.quarantined_until, "quarantine_reason": self.quarantine_reason}
+
+    def stats(self, now):
+        return {
+            "id": self.id,
+            "label": self.label,
+            "uses": self.uses,
+            "successes": self.successes,
+            "failures": self.failures,
+            "success_rate": round(self.success_rate, 3),
+            "last_used": self.last_used or None,
+            "last_error": self.last_error,
+            "quarantined": self.quarantined(now),
+            "quarantined_until": self.quarantined_until if self.quarantined(now) else None,
+            "quarantine_reason": self.quarantine_reason if self.quarantined(now) else None,
+        }
+
+
+class CookiePool:
+    """
+    Terabox accounts used for resolves that bring no cookie of their own.
+    Each resolve takes the healthiest account (recent success rate, in steps of 10%),
+    least recently used first. Accounts that get logged out or throttled are
+    quarantined for a while. Loaded once; each account is persisted under its own
+    state key, so workers sharing the backend only ever write the account they changed.
+    State backend calls block, so they run in a thread.
+    """
+
+    def __init__(self, state=STATE):
+        self.state = state
+        self.accounts = {}
+        self.loaded_at = None
+        self._loading = asyncio.Lock()
+
+    async def load(self):
+        records = await asyncio.to_thread(self._read)
+
+        accounts = {}
+        for record in records:
+            account = self.accounts.get(cookie_id(record["cookie"]))
+            if account is None:
+                account = CookieAccount(record["cookie"], record.get("label"), record.get("added_at"))
+            # Another worker may have quarantined it since
+            account.quarantined_until = max(account.quarantined_until, record.get("quarantined_until") or 0.0)
+            account.quarantine_reason = record.get("quarantine_reason") or account.quarantine_reason
+            accounts[account.id] = account
+        self.accounts = accounts
+        self.loaded_at = time.monotonic()
+
+    def _read(self):
+        """Stored account records (blocking; run it in a thread)."""
+        records = list(self.state.get_values(ACCOUNT_KEY).values())
+        self._migrate(records)
+        return records
+
+    def _migrate(self, records):
+        """Moves accounts stored by earlier versions (one list, or a single cookie) to their own keys."""
+        legacy = self.state.get_value("cookie_pool") or []
+        ndus = self.state.get_value("ndus")
+        if ndus:
+            legacy.append({"cookie": ndus, "label": "ndus"})
+        known = {cookie_id(r["cookie"]) for r in records}
+        for record in legacy:
+            if cookie_id(record["cookie"]) not in known:
+                known.add(cookie_id(record["cookie"]))
+                records.append(record)
+                self.state.set_value(ACCOUNT_KEY + cookie_id(record["cookie"]), record)
+        if legacy:
+            self.state.delete_value("cookie_pool")
+            self.state.delete_value("ndus")
+
+    def _stale(self):
+        return self.loaded_at is None or (self.state.shared and time.monotonic() - self.loaded_at > RELOAD_INTERVAL)
+
+    async def _ensure_loaded(self):
+        if self._stale():
+            async with self._loading:
+                # Concurrent callers wait for one load
+                if self._stale():
+                    await self.load()
+
+    async def add(self, cookie: str, label: str = None):
+        await self._ensure_loaded()
+        cookie = cookie.strip()
+        account = self.accounts.get(cookie_id(cookie))
+        if account is None:
+            account = CookieAccount(cookie, label)
+            self.accounts[account.id] = account
+            print(f"Cookie pool: added account {account.id}")
+        else:
+            # Re-adding a known cookie lifts its quarantine
+            account.quarantined_until = 0.0
+            account.label = label or account.label
+        await asyncio.to_thread(self.state.set_value, ACCOUNT_KEY + account.id, account.to_record())
+        return account
+
+    async def remove(self, account_id: str):
+        await self._ensure_loaded()
+        if self.accounts.pop(account_id, None) is None:
+            return False
+        await asyncio.to_thread(self.state.delete_value, ACCOUNT_KEY + account_id)
+        return True
+
+    async def acquire(self):
+        """Returns the account to use for the next resolve, or None when none is available."""
+        await self._ensure_loaded()
+        now = time.time()
+        available = [a for a in self.accounts.values() if not a.quarantined(now)]
+        if not available:
+            return None
+        account = min(available, key=lambda a: (-int(a.success_rate * 10), a.last_used))
+        account.uses += 1
+        account.last_used = now
+        return account
+
+    async def report(self, account, result):
+        """
+        Records a resolve outcome. Returns True when the account was quarantined,
+        i.e. the resolve is worth retrying with another account.
+        """
+        error = result.get("error")
+        if not error:
+            account.successes += 1
+            account.streak = 0
+            account.recent.append(1)
+            return False
+
+        details = f"{error} {result.get('details') or ''}".lower()
+        if any(marker in details for marker in SHARE_ERROR_MARKERS):
+            return False
+
+        account.failures += 1
+        account.streak += 1
+        account.recent.append(0)
+        account.last_error = error
+        if error == "LOGIN_REQUIRED":
+            await self._quarantine(account, COOKIE_QUARANTINE_LOGIN, "login_required")
+            return True
+        if any(marker in details for marker in THROTTLE_MARKERS) or account.streak >= COOKIE_FAILURE_STREAK:
+            await self._quarantine(account, COOKIE_QUARANTINE_THROTTLE, "throttled")
+            return True
+        return False
+
+    async def _quarantine(self, account, duration, reason):
+        account.quarantined_until = time.time() + duration
+        account.quarantine_reason = reason
+        account.streak = 0
+        print(f"Cookie pool: quarantined account {account.id} ({reason}) for {int(duration)}s")
+        # Only if still stored: another worker may have removed it
+        await asyncio.to_thread(self.state.update_value, ACCOUNT_KEY + account.id, account.to_record())
+
+    async def stats(self):
+        await self._ensure_loaded()
+        now = time.time()
+        return {
+            "accounts": len(self.accounts),
+            "available": sum(1 for a in self.accounts.values() if not a.quarantined(now)),
+            "per_account": [a.stats(now) for a in self.accounts.values()],
+        }
+
+
+# Shared pool of Terabox accounts
+COOKIE_POOL = CookiePool()
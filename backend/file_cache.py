@@ -0,0 +1,142 @@
+import asyncio
+import os
+import sys
+import time
+from collections import OrderedDict
+from resolve_cache import link_expiry, LINK_EXPIRY_MARGIN
+from state import STATE
+
+# File cache tuning (overridable from the environment)
+FILE_CACHE_MAX_BYTES = int(os.environ.get("FILE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+FILE_CACHE_TTL = float(os.environ.get("FILE_CACHE_TTL", str(6 * 3600)))  # For links without a known expiry
+PURGE_EVERY = 256  # Inserts between scans for expired records
+
+# Headers the download proxy forwards upstream; nothing else of a resolve result is kept
+UPSTREAM_HEADERS = ['User-Agent', 'Cookie', 'Referer']
+
+
+class FileRecord:
+    __slots__ = ("url", "filename", "size", "headers", "expires_at", "source_url", "path", "cookie", "nbytes")
+
+    def __init__(self, url, filename, size, headers, expires_at, source_url=None, path=None, cookie=None):
+        self.url = url
+        self.filename = filename
+        self.size = size
+        self.headers = headers
+        self.expires_at = expires_at
+        self.source_url = source_url  # Share/page URL the link was resolved from, to refresh it
+        self.path = path  # Position in a multi-file share
+        self.cookie = cookie  # Cookie the link was resolved with (None: a pool account), to refresh it alike
+        self.nbytes = sys.getsizeof(self) + sum(
+            sys.getsizeof(s) for s in (url, filename, source_url, path, cookie, *headers.keys(), *headers.values())
+            if s
+        )
+
+
+class FileCache:
+    """
+    fileId -> what /api/download needs to proxy a resolved link (URL, filename, size
+    and upstream headers). Records expire with their signed link, unless they know the
+    share/page it was resolved from (the download proxy then refreshes the link), and
+    the least recently used are evicted once the estimated footprint exceeds `max_bytes`.
+    Records are written through to the state backend, so with a shared backend a
+    fileId handed out by one worker can be downloaded from any other.
+    """
+
+    def __init__(self, max_bytes: int = FILE_CACHE_MAX_BYTES, ttl: float = FILE_CACHE_TTL, state=STATE):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.state = state
+        self._records = OrderedDict()
+        self._inserts = 0
+
+        # Stats
+        self.bytes = 0
+        self.evicted = 0
+        self.expired = 0
+
+    async def put(self, file_id: str, url: str, filename: str, size: int = 0, headers: dict = None,
+                  source_url: str = None, path: str = None, cookie: str = None):
+        return (await self.put_many([(file_id, url, filename, size, headers, source_url, path, cookie)]))[0]
+
+    async def put_many(self, entries):
+        """
+        Stores (file_id, url, filename, size, headers, source_url, path, cookie) tuples and returns
+        their records. A shared backend gets them in one write, off the event loop.
+        """
+        records, rows = [], []
+        for file_id, url, filename, size, headers, source_url, path, cookie in entries:
+            headers = {k: v for k, v in (headers or {}).items() if k in UPSTREAM_HEADERS}
+            expires_at = time.time() + self.ttl
+            expiry = link_expiry(url)
+            if expiry and not source_url:
+                # Without a source to refresh it from, the record is useless once its link expires
+                expires_at = min(expires_at, expiry - LINK_EXPIRY_MARGIN)
+            rows.append((file_id, {"url": url, "filename": filename, "size": int(size or 0), "headers": headers,
+                                   "expires_at": expires_at, "source_url": source_url, "path": path,
+                                   "cookie": cookie}, expires_at))
+            records.append(self._insert(file_id, FileRecord(url, filename, int(size or 0), headers, expires_at,
+                                                            source_url, path, cookie)))
+        if self.state.shared:
+            await asyncio.to_thread(self.state.put_files, rows)
+        return records
+
+    def _insert(self, file_id, record):
+        self._drop(file_id)
+        self._records[file_id] = record
+        self.bytes += record.nbytes + sys.getsizeof(file_id)
+
+        self._inserts += 1
+        if self._inserts % PURGE_EVERY == 0:
+            self.purge()
+        while self.bytes > self.max_bytes and len(self._records) > 1:
+            self._drop(next(iter(self._records)))
+            self.evicted += 1
+        return record
+
+    async def get(self, file_id: str):
+        record = self._records.get(file_id)
+        if record is None:
+            # Handed out by another worker
+            fields = await asyncio.to_thread(self.state.get_file, file_id) if self.state.shared else None
+            if not fields:
+                return None
+            record = self._insert(file_id, FileRecord(fields["url"], fields["filename"], fields["size"],
+                                                      fields["headers"], fields["expires_at"],
+                                                      fields.get("source_url"), fields.get("path"),
+                                                      fields.get("cookie")))
+        if record.expires_at <= time.time():
+            self._drop(file_id)
+            self.expired += 1
+            return None
+        self._records.move_to_end(file_id)
+        return record
+
+    def _drop(self, file_id):
+        record = self._records.pop(file_id, None)
+        if record is not None:
+            self.bytes -= record.nbytes + sys.getsizeof(file_id)
+
+    def purge(self):
+        """Removes every expired record."""
+        now = time.time()
+        for file_id in [k for k, r in self._records.items() if r.expires_at <= now]:
+            self._drop(file_id)
+            self.expired += 1
+
+    def __len__(self):
+        return len(self._records)
+
+    def stats(self):
+        return {
+            "entries": len(self._records),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "occupancy": round(self.bytes / self.max_bytes, 3) if self.max_bytes else 0.0,
+            "evicted": self.evicted,
+            "expired": self.expired,
+        }
+
+
+# Shared store of resolved links, filled by /api/resolve and read by /api/download
+FILE_CACHE = FileCache()
@@ -0,0 +1,88 @@
+import mimetypes
+import os
+import re
+import time
+from universal_downloader import DOWNLOAD_DIR, OUTPUT_EXTS
+from state import STATE
+
+COMPLETE_RE = re.compile(r"^[^.]+\.(%s)$" % "|".join(OUTPUT_EXTS))
+OUTPUT_KEY_RE = re.compile(r"^[0-9a-f]{32}$")
+
+
+class FileEntry:
+    __slots__ = ("file_id", "filename", "path", "size", "mtime", "mime")
+
+    def __init__(self, file_id, filename, path, size, mtime, mime):
+        self.file_id = file_id
+        self.filename = filename
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        self.mime = mime
+
+
+class FileIndex:
+    """
+    In-memory index of finished outputs in the downloads directory, keyed by file_id.
+    Built once at startup and kept current as jobs finish and the janitor evicts,
+    so serving a processed file never lists the directory. With `probe_disk`
+    (several workers sharing the directory), a miss checks for an output another
+    worker finished since.
+    """
+
+    def __init__(self, directory: str = DOWNLOAD_DIR, probe_disk: bool = STATE.shared):
+        self.directory = directory
+        self.probe_disk = probe_disk
+        self.entries = {}
+        self.built_at = None
+
+    def build(self):
+        """Scans the directory once (blocking; run it in a thread)."""
+        entries = {}
+        if os.path.isdir(self.directory):
+            with os.scandir(self.directory) as it:
+                for entry in it:
+                    if entry.is_file() and COMPLETE_RE.match(entry.name):
+                        indexed = self._entry(entry.name, entry.path, entry.stat())
+                        entries[indexed.file_id] = indexed
+        self.entries = entries
+        self.built_at = time.time()
+        print(f"File index built ({len(entries)} files)")
+
+    def _entry(self, filename, path, stat):
+        mime = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        return FileEntry(filename.split('.')[0], filename, path, stat.st_size, stat.st_mtime, mime)
+
+    def add(self, path: str):
+        filename = os.path.basename(path)
+        try:
+            entry = self._entry(filename, path, os.stat(path))
+        except OSError:
+            return None
+        self.entries[entry.file_id] = entry
+        return entry
+
+    def get(self, file_id: str):
+        entry = self.entries.get(file_id)
+        if entry is None and self.probe_disk and OUTPUT_KEY_RE.match(file_id):
+            for ext in OUTPUT_EXTS:
+                entry = self.add(os.path.join(self.directory, f"{file_id}.{ext}"))
+                if entry:
+                    break
+        return entry
+
+    def discard(self, filename: str):
+        entry = self.entries.get(filename.split('.')[0])
+        if entry and entry.filename == filename:
+            del self.entries[entry.file_id]
+
+    def stats(self):
+        return {
+            "files": len(self.entries),
+            "bytes": sum(e.size for e in self.entries.values()),
+            "built_at": self.built_at,
+        }
+
+
+# Shared index, built by the FastAPI app lifespan
+FILE_INDEX = FileIndex()
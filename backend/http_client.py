@@ -0,0 +1,68 @@
+import os
+import aiohttp
+
+# Connection tuning (overridable from the environment)
+HTTP_MAX_CONNECTIONS = int(os.environ.get("HTTP_MAX_CONNECTIONS", "256"))
+HTTP_MAX_PER_HOST = int(os.environ.get("HTTP_MAX_PER_HOST", "32"))
+HTTP_KEEPALIVE = float(os.environ.get("HTTP_KEEPALIVE", "30"))  # Seconds an idle connection is kept
+HTTP_DNS_TTL = int(os.environ.get("HTTP_DNS_TTL", "300"))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", "10"))
+HTTP_READ_TIMEOUT = float(os.environ.get("HTTP_READ_TIMEOUT", "60"))  # Max stall between two reads
+
+
+class SharedHttpClient:
+    """
+    App-wide aiohttp session with a tuned, shared connector, so downloads reuse
+    TCP/TLS connections and cached DNS lookups to the same CDN hosts.
+    """
+
+    def __init__(self):
+        self._connector = None
+        self._session = None
+
+    @property
+    def started(self):
+        return self._session is not None and not self._session.closed
+
+    async def start(self):
+        if self.started:
+            return
+        self._connector = aiohttp.TCPConnector(
+            limit=HTTP_MAX_CONNECTIONS,
+            limit_per_host=HTTP_MAX_PER_HOST,
+            ttl_dns_cache=HTTP_DNS_TTL,
+            keepalive_timeout=HTTP_KEEPALIVE,
+            enable_cleanup_closed=True,
+        )
+        self._session = aiohttp.ClientSession(
+            connector=self._connector,
+            # Streams can run for hours; only bound connecting and stalls
+            timeout=aiohttp.ClientTimeout(total=None, connect=HTTP_CONNECT_TIMEOUT, sock_read=HTTP_READ_TIMEOUT),
+            # Per-download cookies are sent as headers; never share a jar between users
+            cookie_jar=aiohttp.DummyCookieJar(),
+            # No auto-decompression: byte ranges and Content-Length refer to the raw body
+            auto_decompress=False,
+        )
+        print(f"HTTP client started (limit {HTTP_MAX_CONNECTIONS}, {HTTP_MAX_PER_HOST} per host)")
+
+    async def stop(self):
+        if self._session is not None:
+            await self._session.close()
+        self._session = None
+        self._connector = None
+
+    async def session(self):
+        """The shared session, started lazily outside the app lifespan (scripts, tests)."""
+        if not self.started:
+            await self.start()
+        return self._session
+
+    async def connector(self):
+        """The shared connector, for short-lived sessions that need their own cookie jar."""
+        if not self.started:
+            await self.start()
+        return self._connector
+
+
+# Shared client, started/stopped by the FastAPI app lifespan
+HTTP_CLIENT = SharedHttpClient()
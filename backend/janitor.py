@@ -0,0 +1,155 @@
+import asyncio
+import os
+import time
+from universal_downloader import DOWNLOAD_DIR
+from file_index import FILE_INDEX, COMPLETE_RE
+
+# Janitor tuning (overridable from the environment)
+DOWNLOADS_QUOTA_BYTES = int(os.environ.get("DOWNLOADS_QUOTA_BYTES", str(10 * 1024 ** 3)))
+DOWNLOADS_MAX_AGE = float(os.environ.get("DOWNLOADS_MAX_AGE", str(24 * 3600)))  # Seconds since last served
+PARTIAL_MAX_AGE = float(os.environ.get("PARTIAL_MAX_AGE", "3600"))  # Untouched fragments older than this are orphans
+JANITOR_INTERVAL = float(os.environ.get("JANITOR_INTERVAL", "60"))
+LEASE_TIMEOUT = 6 * 3600  # A stream that never reported back stops protecting its file after this long
+
+
+class Janitor:
+    """
+    Keeps the downloads directory within a byte quota and a max age.
+    Finished outputs are evicted least-recently-served first; files that are
+    being streamed are never deleted, and partial fragments left behind by
+    crashed yt-dlp runs are removed once they stop changing.
+    """
+
+    def __init__(self, directory: str = DOWNLOAD_DIR, quota: int = DOWNLOADS_QUOTA_BYTES,
+                 max_age: float = DOWNLOADS_MAX_AGE):
+        self.directory = directory
+        self.quota = quota
+        self.max_age = max_age
+        self.last_served = {}  # filename -> unix time
+        self.streams = {}  # filename -> [open streams, last acquire time]
+        self._active_keys = lambda: ()
+        self._task = None
+
+        # Stats
+        self.total_bytes = 0
+        self.files = 0
+        self.evicted_files = 0
+        self.evicted_bytes = 0
+        self.partials_removed = 0
+        self.last_sweep = None
+
+    async def start(self, active_keys=None):
+        """`active_keys()` returns output keys of running jobs, whose fragments must be kept."""
+        if active_keys:
+            self._active_keys = active_keys
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    # Serving hooks
+
+    def acquire(self, filename: str):
+        """Marks a file as being streamed (and served now)."""
+        now = time.time()
+        self.last_served[filename] = now
+        lease = self.streams.setdefault(filename, [0, now])
+        lease[0] += 1
+        lease[1] = now
+
+    def release(self, filename: str):
+        lease = self.streams.get(filename)
+        if lease:
+            lease[0] -= 1
+            if lease[0] <= 0:
+                del self.streams[filename]
+
+    def in_use(self, filename: str):
+        lease = self.streams.get(filename)
+        return bool(lease) and lease[0] > 0 and time.time() - lease[1] < LEASE_TIMEOUT
+
+    # Sweeping
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.sweep()
+            except Exception as e:
+                print(f"Janitor sweep failed: {e}")
+            await asyncio.sleep(JANITOR_INTERVAL)
+
+    def _scan(self, active_keys):
+        """Runs in a thread: lists complete outputs and orphaned partials."""
+        now = time.time()
+        outputs, orphans = [], []
+        if not os.path.isdir(self.directory):
+            return outputs, orphans
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if not entry.is_file():
+                    continue
+                stat = entry.stat()
+                if COMPLETE_RE.match(entry.name):
+                    outputs.append((entry.name, stat.st_size, stat.st_mtime))
+                elif entry.name.split('.')[0] not in active_keys and now - stat.st_mtime > PARTIAL_MAX_AGE:
+                    # .part/.ytdl/.temp/.fNNN leftovers of a run that is no longer active
+                    orphans.append((entry.name, stat.st_size))
+        return outputs, orphans
+
+    def _remove(self, filename):
+        try:
+            os.remove(os.path.join(self.directory, filename))
+            self.last_served.pop(filename, None)
+            FILE_INDEX.discard(filename)
+            return True
+        except OSError as e:
+            print(f"Janitor could not remove {filename}: {e}")
+            return False
+
+    async def sweep(self):
+        started = time.monotonic()
+        outputs, orphans = await asyncio.to_thread(self._scan, set(self._active_keys()))
+
+        for name, size in orphans:
+            if not self.in_use(name) and self._remove(name):
+                self.partials_removed += 1
+
+        now = time.time()
+        # Least recently served first; files never served since startup count from their mtime
+        outputs.sort(key=lambda o: self.last_served.get(o[0], o[2]))
+        total = sum(size for _, size, _ in outputs)
+        kept = 0
+        for name, size, mtime in outputs:
+            last_used = self.last_served.get(name, mtime)
+            expired = now - last_used > self.max_age
+            if (expired or total > self.quota) and not self.in_use(name) and self._remove(name):
+                total -= size
+                self.evicted_files += 1
+                self.evicted_bytes += size
+            else:
+                kept += 1
+
+        self.total_bytes = total
+        self.files = kept
+        self.last_sweep = {"at": now, "duration": round(time.monotonic() - started, 3)}
+
+    def stats(self):
+        return {
+            "quota_bytes": self.quota,
+            "max_age": self.max_age,
+            "total_bytes": self.total_bytes,
+            "files": self.files,
+            "streaming": sum(lease[0] for lease in self.streams.values()),
+            "evicted_files": self.evicted_files,
+            "evicted_bytes": self.evicted_bytes,
+            "partials_removed": self.partials_removed,
+            "last_sweep": self.last_sweep,
+        }
+
+
+# Shared janitor, started/stopped by the FastAPI app lifespan
+JANITOR = Janitor()
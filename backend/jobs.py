@@ -0,0 +1,353 @@
+import asyncio
+import json
+import os
+import time
+import uuid
+from universal_downloader import UniversalDownloader
+from file_index import FILE_INDEX
+from state import STATE
+from metrics import JOB_QUEUE_WAIT_SECONDS, JOB_MERGE_SECONDS, JOB_SECONDS
+
+# Job queue tuning (overridable from the environment)
+PROCESS_CONCURRENCY = int(os.environ.get("PROCESS_CONCURRENCY", "2"))  # Concurrent downloads/merges
+PROCESS_QUEUE_SIZE = int(os.environ.get("PROCESS_QUEUE_SIZE", "100"))
+JOB_RETENTION = float(os.environ.get("JOB_RETENTION", "3600"))  # Seconds finished jobs stay queryable
+SSE_KEEPALIVE = 15
+JOB_PERSIST_INTERVAL = 1.0  # Max rate progress snapshots are written to a shared state backend
+JOB_POLL_INTERVAL = 1.0  # How often events for another worker's job are re-read
+JOB_CLAIM_TTL = 6 * 3600  # Backstop for an output claim whose worker never released it
+
+FINAL_STATES = ("finished", "error")
+
+
+class QueueFullError(Exception):
+    pass
+
+
+def _written():
+    done = asyncio.get_running_loop().create_future()
+    done.set_result(None)
+    return done
+
+
+class Job:
+    def __init__(self, url: str, format_id: str, output_key: str = None):
+        self.id = str(uuid.uuid4())
+        self.url = url
+        self.format_id = format_id
+        self.output_key = output_key
+        self.status = "queued"
+        self.phase = None
+        self.downloaded_bytes = 0
+        self.total_bytes = 0
+        self.speed = None
+        self.eta = None
+        self.file_id = None
+        self.filename = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+        self.version = 0
+        self.persisted_at = 0.0
+        self._changed = asyncio.Event()
+
+    @property
+    def done(self):
+        return self.status in FINAL_STATES
+
+    def update(self, **fields):
+        for key, value in fields.items():
+            setattr(self, key, value)
+        if "phase" in fields and not self.done:
+            self.status = fields["phase"]
+        self.version += 1
+        # Wake everyone waiting on the previous version
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def wait_for_update(self, version: int, timeout: float):
+        """Waits until the job moves past `version`; returns False on timeout."""
+        changed = self._changed
+        if self.version != version:
+            return True
+        try:
+            await asyncio.wait_for(changed.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def to_dict(self):
+        progress = None
+        if self.status == "finished":
+            progress = 100.0
+        elif self.total_bytes:
+            progress = round(min(self.downloaded_bytes / self.total_bytes, 1.0) * 100, 1)
+        return {
+            "jobId": self.id,
+            "status": self.status,
+            "phase": self.phase,
+            "progress": progress,
+            "downloadedBytes": self.downloaded_bytes,
+            "totalBytes": self.total_bytes,
+            "speed": self.speed,
+            "eta": self.eta,
+            "fileId": self.file_id,
+            "filename": self.filename,
+            "error": self.error,
+            "createdAt": self.created_at,
+            "startedAt": self.started_at,
+            "finishedAt": self.finished_at,
+        }
+
+
+class JobSnapshot:
+    """Read-only view of a job that runs on another worker, as last persisted."""
+
+    def __init__(self, data):
+        self.id = data["jobId"]
+        self.data = data
+
+    @property
+    def status(self):
+        return self.data["status"]
+
+    @property
+    def file_id(self):
+        return self.data.get("fileId")
+
+    @property
+    def done(self):
+        return self.status in FINAL_STATES
+
+    def to_dict(self):
+        return self.data
+
+
+class JobQueue:
+    """
+    Bounded queue of /api/process jobs, drained by a fixed number of workers
+    so at most PROCESS_CONCURRENCY downloads/merges run at once. Job snapshots are
+    written to the state backend, so any worker can report on any job, and each
+    output is claimed there before it is queued, so two workers never run yt-dlp
+    into the same output file.
+    """
+
+    def __init__(self, concurrency: int = PROCESS_CONCURRENCY, max_queued: int = PROCESS_QUEUE_SIZE, state=STATE):
+        self.concurrency = max(1, concurrency)
+        self.max_queued = max_queued
+        self.state = state
+        self.jobs = {}
+        self._active = {}  # output key -> queued/running job
+        self._queue = None
+        self._workers = []
+        self._unsaved = {}  # job id -> (snapshot, expires_at) waiting for the writer
+        self._unsaved_written = None  # Future resolved once those are written
+        self._writer = None
+
+        # Stats
+        self.reused = 0
+        self.attached = 0
+
+    @property
+    def started(self):
+        return bool(self._workers)
+
+    async def start(self):
+        if self.started:
+            return
+        self._queue = asyncio.Queue(maxsize=self.max_queued)
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+        print(f"Job queue started ({self.concurrency} workers)")
+
+    async def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        if self._writer:
+            # Final snapshots of the cancelled jobs
+            await asyncio.gather(self._writer, return_exceptions=True)
+
+    async def submit(self, url: str, format_id: str):
+        if not self.started:
+            await self.start()
+        self._prune()
+        output_key = UniversalDownloader.output_key(url, UniversalDownloader.format_selector(format_id))
+
+        # Same item already being processed: attach to that job
+        active = self._active.get(output_key)
+        if active and not active.done:
+            self.attached += 1
+            return active
+
+        job = Job(url, format_id, output_key)
+
+        # Same item processed before: finished immediately from disk
+        entry = FILE_INDEX.get(output_key)
+        if entry:
+            self.reused += 1
+            job.update(status="finished", file_id=output_key, filename=entry.filename, finished_at=time.time())
+            self.jobs[job.id] = job
+            await self._persist(job)
+            return job
+
+        # Another worker sharing the downloads directory may be processing it already
+        holder = await asyncio.to_thread(self.state.claim, output_key, job.id, time.time() + JOB_CLAIM_TTL)
+        if holder != job.id:
+            self.attached += 1
+            # Its snapshot may not be written yet: report it as queued until then
+            data = await asyncio.to_thread(self.state.get_job, holder)
+            if data is None:
+                job.id = holder
+                data = job.to_dict()
+            return JobSnapshot(data)
+
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            await asyncio.to_thread(self.state.release, output_key, job.id)
+            raise QueueFullError("Processing queue is full, try again later")
+        self.jobs[job.id] = job
+        self._active[output_key] = job
+        # Written before answering, so the jobId can be polled on any worker right away
+        await self._persist(job)
+        return job
+
+    def active_keys(self):
+        return list(self._active.keys())
+
+    async def get(self, job_id: str):
+        job = self.jobs.get(job_id)
+        if job is None and self.state.shared:
+            data = await asyncio.to_thread(self.state.get_job, job_id)
+            if data:
+                return JobSnapshot(data)
+        return job
+
+    def _persist(self, job, force=True):
+        """
+        Queues a snapshot of `job` for the state backend. Snapshots are written in
+        batches by one background writer (latest per job wins); the returned future
+        resolves once this one is written.
+        """
+        if not self.state.shared:
+            return _written()
+        now = time.time()
+        if force or job.done or now - job.persisted_at >= JOB_PERSIST_INTERVAL:
+            job.persisted_at = now
+            self._unsaved[job.id] = (job.to_dict(), now + JOB_RETENTION)
+            if self._unsaved_written is None:
+                self._unsaved_written = asyncio.get_running_loop().create_future()
+            if self._writer is None:
+                self._writer = asyncio.create_task(self._write_snapshots())
+        return self._unsaved_written or _written()
+
+    async def _write_snapshots(self):
+        try:
+            while self._unsaved:
+                batch, written = self._unsaved, self._unsaved_written
+                self._unsaved, self._unsaved_written = {}, None
+                try:
+                    await asyncio.to_thread(self.state.put_jobs, [(k, *v) for k, v in batch.items()])
+                except Exception as e:
+                    print(f"Job queue: could not persist {len(batch)} job snapshots: {e}")
+                written.set_result(None)
+        finally:
+            self._writer = None
+
+    def _prune(self):
+        cutoff = time.time() - JOB_RETENTION
+        for job_id in [j.id for j in self.jobs.values() if j.done and j.finished_at < cutoff]:
+            del self.jobs[job_id]
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            try:
+                job.update(status="downloading", phase="downloading", started_at=time.time())
+                self._persist(job)
+                JOB_QUEUE_WAIT_SECONDS.observe(job.started_at - job.created_at)
+                merge = {}
+
+                def on_progress(event, job=job):
+                    if event.get("phase") == "merging":
+                        merge.setdefault("started", time.monotonic())
+                    job.update(**event)
+                    self._persist(job, force=False)
+
+                file_path, filename = await UniversalDownloader.process_download(job.url, job.format_id, on_progress)
+                if "started" in merge:
+                    JOB_MERGE_SECONDS.observe(time.monotonic() - merge["started"])
+                if file_path:
+                    FILE_INDEX.add(file_path)
+                    job.update(status="finished", phase=None, file_id=filename.split('.')[0],
+                               filename=filename, finished_at=time.time())
+                else:
+                    job.update(status="error", error="Processing failed", finished_at=time.time())
+            except Exception as e:
+                print(f"Job {job.id} failed: {e}")
+                job.update(status="error", error=str(e), finished_at=time.time())
+            finally:
+                JOB_SECONDS.observe(time.time() - (job.started_at or job.created_at), job.status)
+                # Written before the claim is released, so a new claimant sees the outcome
+                await self._persist(job)
+                self._active.pop(job.output_key, None)
+                self._queue.task_done()
+                try:
+                    await asyncio.to_thread(self.state.release, job.output_key, job.id)
+                except Exception as e:
+                    print(f"Job {job.id}: could not release its output claim: {e}")
+
+    async def events(self, job: Job):
+        """Server-Sent Events stream of job snapshots, ending once the job is done."""
+        if isinstance(job, JobSnapshot):
+            async for event in self._polled_events(job):
+                yield event
+            return
+
+        version = -1
+        while True:
+            if job.version != version:
+                version = job.version
+                yield f"data: {json.dumps(job.to_dict())}\n\n"
+                if job.done:
+                    return
+            elif not await job.wait_for_update(version, SSE_KEEPALIVE):
+                yield ": keepalive\n\n"
+
+    async def _polled_events(self, job: JobSnapshot):
+        """Events for another worker's job, re-read from the state backend."""
+        last = None
+        idle = 0.0
+        while True:
+            data = await asyncio.to_thread(self.state.get_job, job.id) or job.data
+            if data != last:
+                last = data
+                idle = 0.0
+                yield f"data: {json.dumps(data)}\n\n"
+                if data["status"] in FINAL_STATES:
+                    return
+            elif idle >= SSE_KEEPALIVE:
+                idle = 0.0
+                yield ": keepalive\n\n"
+            await asyncio.sleep(JOB_POLL_INTERVAL)
+            idle += JOB_POLL_INTERVAL
+
+    def stats(self):
+        counts = {}
+        for job in self.jobs.values():
+            counts[job.status] = counts.get(job.status, 0) + 1
+        return {
+            "concurrency": self.concurrency,
+            "queued": self._queue.qsize() if self._queue else 0,
+            "max_queued": self.max_queued,
+            "reused": self.reused,
+            "attached": self.attached,
+            "jobs": counts,
+        }
+
+
+# Shared queue, started/stopped by the FastAPI app lifespan
+JOB_QUEUE = JobQueue()
@@ -2,15 +2,74 @@ import uuid
 import aiohttp
 import uvicorn
 from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import JSONResponse, StreamingResponse, FileResponse
+from fastapi.responses import JSONResponse, StreamingResponse, FileResponse, Response, RedirectResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from universal_downloader import UniversalDownloader
+from universal_downloader import UniversalDownloader, DOWNLOAD_DIR
+from browser_pool import BROWSER_POOL
+from resolve_cache import RESOLVE_CACHE, link_expiry
+from http_client import HTTP_CLIENT
+from segmented import SegmentedDownload, segment_span, parse_content_range
+from jobs import JOB_QUEUE, QueueFullError
+from janitor import JANITOR
+from file_index import FILE_INDEX
+from file_cache import FILE_CACHE
+from state import STATE
+from cookie_pool import COOKIE_POOL
+from mirrors import MIRRORS
+from proxy_cache import PROXY_CACHE, upstream_key, parse_range
+import metrics
+from metrics import Gauge, ACTIVE_STREAMS, PROXY_BYTES, PROXY_THROUGHPUT, PROXY_TTFB_SECONDS, UPSTREAM_ERRORS
+from remux import open_remux_stream, RemuxError, active_keys as streaming_keys
+from ytdlp_pool import YTDLP_POOL
+from zipstream import ZipMember, stream_zip, unique_names, zip_size
+import asyncio
+from contextlib import asynccontextmanager
+from functools import partial
 import os
 import shutil
-from typing import Optional
+import time
+from typing import List, Optional
 
-app = FastAPI()
+# Launch the yt-dlp workers and a browser in the background at startup. Off by default:
+# on scale-to-zero hosts a cold start should only pay for what its first request needs.
+PREWARM = os.environ.get("PREWARM", "0").lower() in ("1", "true", "yes")
+WARMUP = {"status": "running" if PREWARM else "disabled", "started_at": None, "finished_at": None, "errors": {}}
+
+async def prewarm():
+    WARMUP["started_at"] = time.time()
+    results = await asyncio.gather(YTDLP_POOL.warm(), BROWSER_POOL.start(), return_exceptions=True)
+    for name, result in zip(("ytdlp", "browser"), results):
+        if isinstance(result, Exception):
+            print(f"Prewarm of {name} failed (will retry on first use): {result}")
+            WARMUP["errors"][name] = str(result)
+    WARMUP.update(status="done", finished_at=time.time())
+    print(f"Prewarm finished in {WARMUP['finished_at'] - WARMUP['started_at']:.1f}s")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await HTTP_CLIENT.start()
+    os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+    await asyncio.to_thread(FILE_INDEX.build)
+    await PROXY_CACHE.start()
+    await JOB_QUEUE.start()
+    # Enforces the downloads quota/max age and removes fragments of crashed runs
+    # (but not those of running jobs or of streams saving a copy)
+    await JANITOR.start(active_keys=lambda: JOB_QUEUE.active_keys() + streaming_keys())
+    # yt-dlp workers and browsers otherwise start on first use
+    warmup = asyncio.create_task(prewarm()) if PREWARM else None
+    yield
+    if warmup:
+        warmup.cancel()
+        await asyncio.gather(warmup, return_exceptions=True)
+    await JANITOR.stop()
+    await JOB_QUEUE.stop()
+    await PROXY_CACHE.stop()
+    await BROWSER_POOL.stop()
+    await YTDLP_POOL.stop()
+    await HTTP_CLIENT.stop()
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -20,59 +79,49 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# In-memory storage for file metadata (URL, headers, etc.)
-# Key: file_id, Value: dict
-FILE_CACHE = {}
 
 class URLRequest(BaseModel):
     url: str
     cookie: Optional[str] = None
 
+class BatchResolveRequest(BaseModel):
+    urls: List[str]
+    cookie: Optional[str] = None
+
+class CookieRequest(BaseModel):
+    cookie: str
+    label: Optional[str] = None
+
 class ProcessRequest(BaseModel):
     url: str
     format_id: str
 
 import json
 
-# Cookie Storage
-COOKIE_FILE = "cookies.json"
-
-def load_stored_cookie():
-    if os.path.exists(COOKIE_FILE):
-        try:
-            with open(COOKIE_FILE, 'r') as f:
-                data = json.load(f)
-                return data.get("ndus")
-        except:
-            return None
-    return None
-
-def save_stored_cookie(cookie_value):
-    with open(COOKIE_FILE, 'w') as f:
-        json.dump({"ndus": cookie_value}, f)
+# Upper bound on URLs accepted by one /api/resolve/batch call
+RESOLVE_BATCH_MAX_URLS = int(os.environ.get("RESOLVE_BATCH_MAX_URLS", "100"))
 
-@app.post("/api/resolve")
-async def resolve_url(request: URLRequest):
-    # Use provided cookie OR fallback to stored cookie
-    effective_cookie = request.cookie or load_stored_cookie()
-    
-    print(f"Resolving URL: {request.url} (Cookie Active: {bool(effective_cookie)})")
-    
-    # If a cookie was provided in this request, suggest saving it? 
-    # For now, we just use it.
-    
-    result = await UniversalDownloader.resolve(request.url, effective_cookie)
+async def resolve_entry(url: str, cookie: Optional[str]):
+    """Resolves one URL and registers it under a new fileId. Returns the API payload."""
+    result = await UniversalDownloader.resolve(url, cookie)
     
     if "error" in result:
-        return JSONResponse(status_code=400, content={"success": False, "error": result["error"], "details": result.get("details")})
-    
-    # Smart Auth: If the request succeeded with a manually provided cookie, save it for future use.
-    if request.cookie:
-        print("Auto-saving working cookie for future requests.")
-        save_stored_cookie(request.cookie)
+        return {"success": False, "error": result["error"], "details": result.get("details")}
     
     file_id = str(uuid.uuid4())
-    FILE_CACHE[file_id] = result
+    share_files = result.get("files") or []
+    entries = [(file_id, result.get("url"), result.get("filename", "download"), result.get("size"),
+                result.get("headers"), url, share_files[0].get("path") if share_files else None, cookie)]
+    
+    # Multi-file shares: every file gets its own fileId (the first one is the top-level entry)
+    files = []
+    for index, entry in enumerate(share_files):
+        entry_id = file_id if index == 0 else str(uuid.uuid4())
+        if index:
+            entries.append((entry_id, entry["url"], entry["filename"], entry["size"], result.get("headers"),
+                            url, entry.get("path"), cookie))
+        files.append({"fileId": entry_id, **entry})
+    await FILE_CACHE.put_many(entries)
     
     return {
         "success": True, 
@@ -83,86 +132,630 @@ async def resolve_url(request: URLRequest):
         "size": result.get("size", 0),
         "thumbnail": result.get("thumbnail"), 
         "title": result.get("title"),
-        "formats": result.get("formats", [])
+        "formats": result.get("formats", []),
+        "files": files
     }
 
-@app.post("/api/process")
-async def process_media(request: ProcessRequest):
-    print(f"Processing media: {request.url} (Format: {request.format_id})")
-    file_path, filename = await UniversalDownloader.process_download(request.url, request.format_id)
+@app.post("/api/resolve")
+async def resolve_url(request: URLRequest):
+    # Use provided cookie OR fall back to an account from the cookie pool
+    print(f"Resolving URL: {request.url} (Cookie: {'provided' if request.cookie else 'pool'})")
     
-    if not file_path:
-        return JSONResponse(status_code=500, content={"success": False, "error": "Processing failed"})
+    payload = await resolve_entry(request.url, request.cookie)
     
-    # Store minimal metadata to map file_id to filename on disk
-    # We use the filename (uuid.mp4) prefix as the ID
-    file_id = filename.split('.')[0]
+    if not payload["success"]:
+        return JSONResponse(status_code=400, content=payload)
+    
+    # Smart Auth: If the request succeeded with a manually provided cookie, add it to the pool.
+    if request.cookie:
+        print("Adding working cookie to the cookie pool.")
+        await COOKIE_POOL.add(request.cookie)
+    
+    return payload
+
+@app.post("/api/resolve/batch")
+async def resolve_batch(request: BatchResolveRequest):
+    """
+    Resolves many URLs concurrently and streams one JSON line per URL as soon as it
+    is ready (completion order, not request order; each line carries its `index`).
+    Concurrency is bounded per backend by BROWSER_RESOLVE_CONCURRENCY / YTDLP_RESOLVE_CONCURRENCY.
+    """
+    if not request.urls:
+        raise HTTPException(status_code=400, detail="No URLs given")
+    if len(request.urls) > RESOLVE_BATCH_MAX_URLS:
+        raise HTTPException(status_code=400, detail=f"At most {RESOLVE_BATCH_MAX_URLS} URLs per batch")
+
+    print(f"Resolving batch of {len(request.urls)} URLs (Cookie: {'provided' if request.cookie else 'pool'})")
+
+    async def resolve_indexed(index, url):
+        try:
+            payload = await resolve_entry(url, request.cookie)
+        except Exception as e:
+            payload = {"success": False, "error": str(e), "details": None}
+        return {"index": index, "input": url, **payload}
+
+    async def results():
+        tasks = [asyncio.create_task(resolve_indexed(i, url)) for i, url in enumerate(request.urls)]
+        saved = False
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                line = await next_done
+                if line["success"] and request.cookie and not saved:
+                    await COOKIE_POOL.add(request.cookie)
+                    saved = True
+                yield json.dumps(line) + "\n"
+        finally:
+            # Client went away: stop resolving the rest
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(
+        results(),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.get("/api/cookies")
+async def list_cookies():
+    return {"success": True, **(await COOKIE_POOL.stats())}
+
+@app.post("/api/cookies")
+async def add_cookie(request: CookieRequest):
+    account = await COOKIE_POOL.add(request.cookie, request.label)
+    return {"success": True, "id": account.id}
+
+@app.delete("/api/cookies/{account_id}")
+async def remove_cookie(account_id: str):
+    if not await COOKIE_POOL.remove(account_id):
+        raise HTTPException(status_code=404, detail="Account not found")
+    return {"success": True}
+
+@app.post("/api/process")
+async def process_media(request: ProcessRequest):
+    print(f"Queueing media processing: {request.url} (Format: {request.format_id})")
+    try:
+        job = await JOB_QUEUE.submit(request.url, request.format_id)
+    except QueueFullError as e:
+        return JSONResponse(status_code=503, content={"success": False, "error": str(e)})
     
+    # Processing runs in the background; progress is available from /api/jobs/{jobId}.
+    # Outputs processed before come back already finished, with their fileId.
     return {
         "success": True,
-        "fileId": file_id,
-        "filename": filename,
-        "processed": True
+        "jobId": job.id,
+        "status": job.status,
+        "fileId": job.file_id,
+        "processed": job.status == "finished"
+    }
+
+@app.get("/api/jobs/{job_id}")
+async def job_status(job_id: str):
+    job = await JOB_QUEUE.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return {"success": True, **job.to_dict()}
+
+@app.get("/api/jobs/{job_id}/events")
+async def job_events(job_id: str):
+    job = await JOB_QUEUE.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return StreamingResponse(
+        JOB_QUEUE.events(job),
+        media_type="text/event-stream",
+        # Keep nginx from buffering the event stream
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.get("/api/stream")
+async def stream_media(url: str, format_id: str, save: bool = False):
+    """
+    Stream-while-processing: remuxes the selected video + best audio through ffmpeg as
+    fragmented MP4 and sends it while it downloads. `save=true` keeps a copy on disk.
+    """
+    # Already processed: serve the finished file (with range support) instead
+    output_key = UniversalDownloader.output_key(url, UniversalDownloader.format_selector(format_id))
+    if FILE_INDEX.get(output_key):
+        return RedirectResponse(f"/api/download/{output_key}", status_code=307)
+
+    print(f"Streaming media: {url} (Format: {format_id}, save: {save})")
+    try:
+        filename, body = await open_remux_stream(url, format_id, save)
+    except RemuxError as e:
+        return JSONResponse(status_code=502, content={"success": False, "error": "Streaming failed", "details": str(e)})
+    except Exception as e:
+        return JSONResponse(status_code=400, content={"success": False, "error": f"Supported site extraction failed: {e}"})
+
+    return StreamingResponse(
+        metered(body, "remux"),
+        media_type="video/mp4",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+@app.get("/api/ready")
+async def ready():
+    """
+    Readiness probe: 200 once the app can serve requests (and prewarming, if enabled,
+    has finished), 503 before. `warm` tells which slow paths are already warm.
+    """
+    core = {
+        "http_client": HTTP_CLIENT.started,
+        "file_index": FILE_INDEX.built_at is not None,
+        "jobs": JOB_QUEUE.started,
     }
+    is_ready = all(core.values()) and WARMUP["status"] != "running"
+    return JSONResponse(status_code=200 if is_ready else 503, content={
+        "ready": is_ready,
+        "core": core,
+        "warm": {"ytdlp": YTDLP_POOL.ready, "browser": BROWSER_POOL.ready},
+        "prewarm": WARMUP,
+    })
+
+# Sizes sampled when /metrics is scraped
+CACHE_ENTRIES = Gauge("fetchit_cache_entries", "Entries per cache", ["cache"], callback=lambda: {
+    ("resolve",): RESOLVE_CACHE.stats()["entries"],
+    ("file",): len(FILE_CACHE),
+    ("proxy",): PROXY_CACHE.stats()["entries"],
+    ("file_index",): len(FILE_INDEX.entries),
+})
+CACHE_BYTES = Gauge("fetchit_cache_bytes", "Bytes held per cache", ["cache"], callback=lambda: {
+    ("file",): FILE_CACHE.bytes,
+    ("proxy",): PROXY_CACHE.stats()["bytes"],
+    ("downloads",): JANITOR.total_bytes,
+})
+JOBS_QUEUED = Gauge("fetchit_jobs_queued", "/api/process jobs waiting for a worker",
+                    callback=lambda: JOB_QUEUE.stats()["queued"])
+YTDLP_BUSY = Gauge("fetchit_ytdlp_tasks", "yt-dlp pool tasks by state", ["state"], callback=lambda: {
+    ("running",): YTDLP_POOL.running,
+    ("waiting",): YTDLP_POOL.waiting,
+})
 
-@app.get("/api/download/{file_id}")
-async def download_file(file_id: str):
+@app.get("/metrics")
+async def prometheus_metrics():
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/api/stats")
+async def stats():
+    return {
+        "browser_pool": BROWSER_POOL.stats(),
+        "resolve_cache": RESOLVE_CACHE.stats(),
+        "file_cache": FILE_CACHE.stats(),
+        "state": await asyncio.to_thread(STATE.stats),
+        "cookie_pool": await COOKIE_POOL.stats(),
+        "mirrors": MIRRORS.stats(),
+        "proxy_cache": PROXY_CACHE.stats(),
+        "ytdlp_pool": YTDLP_POOL.stats(),
+        "jobs": JOB_QUEUE.stats(),
+        "downloads": JANITOR.stats(),
+        "file_index": FILE_INDEX.stats()
+    }
+
+# Headers forwarded to the upstream from the client (besides the cached UPSTREAM_HEADERS)
+RANGE_HEADERS = ['Range', 'If-Range']
+# Upstream response headers relayed to the client
+RELAYED_HEADERS = ['Content-Length', 'Content-Range', 'Accept-Ranges', 'Content-Encoding', 'ETag', 'Last-Modified']
+
+@app.api_route("/api/download/{file_id}", methods=["GET", "HEAD"])
+async def download_file(file_id: str, request: Request):
     print(f"Download request: {file_id}")
+    received = time.perf_counter()
     
-    # 1. Check for processed file on disk
-    if os.path.exists("downloads"):
-        for f in os.listdir("downloads"):
-            if f.startswith(file_id):
-                file_path = os.path.join("downloads", f)
-                print(f"Serving local file: {file_path}")
-                return FileResponse(file_path, filename=f, media_type="application/octet-stream")
+    # 1. Check for processed file on disk (FileResponse handles Range/If-Range and HEAD itself)
+    entry = FILE_INDEX.get(file_id)
+    if entry:
+        try:
+            stat = os.stat(entry.path)
+        except OSError:
+            # Removed behind the index's back
+            FILE_INDEX.discard(entry.filename)
+            stat = None
+        if stat:
+            print(f"Serving local file: {entry.path}")
+            # Protect the file from eviction while it streams
+            JANITOR.acquire(entry.filename)
+            return MeteredFileResponse(entry.path, filename=entry.filename, media_type=entry.mime,
+                                       stat_result=stat, release=partial(JANITOR.release, entry.filename),
+                                       kind="local", received=received)
 
     # 2. Check for direct download in cache
-    if file_id not in FILE_CACHE:
+    record = await FILE_CACHE.get(file_id)
+    if record is None or not record.url:
         print("File ID not found in cache or disk")
         raise HTTPException(status_code=404, detail="File link expired or invalid")
     
-    file_data = FILE_CACHE[file_id]
-    download_url = file_data["url"]
-    headers = file_data.get("headers", {})
-    filename = file_data["filename"]
-    
-    print(f"Proxying download from: {download_url}")
+    download_url = record.url
+    filename = record.filename
+
+    # 3. Serve from the proxy disk cache when this file (under any fileId) was fetched before
+    cache_id = upstream_key(record.url, record.size)
+    cached = PROXY_CACHE.get(cache_id)
+    if cached:
+        print(f"Serving cached copy of {filename}")
+        return serve_cached(cached, filename, request, received)
     
+    # Usually User-Agent and Cookie are strict requirements for Terabox.
+    upstream_headers = dict(record.headers)
+    # Pass Range/If-Range through so clients can resume and split downloads
+    for name in RANGE_HEADERS:
+        if name in request.headers:
+            upstream_headers[name] = request.headers[name]
+
+    print(f"Proxying download from: {download_url} (Range: {upstream_headers.get('Range', 'none')})")
+
+    try:
+        resp, record = await open_record(file_id, record, upstream_headers)
+        download_url = record.url
+        upstream_headers.update(record.headers)
+    except Exception as e:
+        print(f"Proxy download error: {e}")
+        raise HTTPException(status_code=502, detail="Upstream unavailable")
+
+    response_headers = {"Content-Disposition": f'attachment; filename="{filename}"'}
+    for name in RELAYED_HEADERS:
+        if name in resp.headers:
+            response_headers[name] = resp.headers[name]
+
+    if resp.status == 416:
+        resp.release()
+        return Response(status_code=416, headers=response_headers)
+
+    if resp.status not in (200, 206):
+        print(f"Upstream error: {resp.status}")
+        resp.release()
+        raise HTTPException(status_code=502, detail=f"Upstream returned {resp.status}")
+
+    if resp.status == 206:
+        response_headers["Accept-Ranges"] = "bytes"
+
+    if request.method == "HEAD":
+        resp.release()
+        return Response(status_code=resp.status, headers=response_headers, media_type="application/octet-stream")
+
+    # Large range-capable files are fetched over several connections (CDN throttles per connection)
+    span = segment_span(resp)
+    if span:
+        print(f"Segmented proxy for bytes {span[0]}-{span[1]}")
+        session = await HTTP_CLIENT.session()
+        body = SegmentedDownload(session, download_url, upstream_headers, resp, *span,
+                                 reopen=record_opener(file_id, record)).stream()
+    else:
+        body = proxy_download(resp, file_id, record, upstream_headers)
+
+    # The first full download fills the disk cache; this and concurrent requests then read from it
+    if resp.status == 200 and resp.content_length == record.size and not resp.headers.get("Content-Encoding"):
+        entry = PROXY_CACHE.fill(cache_id, record.size, body)
+        if entry is None:
+            # Another request started filling it while this one was connecting
+            entry = PROXY_CACHE.get(cache_id)
+            if entry:
+                resp.release()
+        if entry:
+            return serve_cached(entry, filename, request, received)
+
     return StreamingResponse(
-        proxy_download(download_url, headers),
+        metered(body, "upstream", received),
+        status_code=resp.status,
         media_type="application/octet-stream",
-        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+        headers=response_headers
     )
 
-async def proxy_download(url, headers):
-    async with aiohttp.ClientSession() as session:
-        # Filter headers that might cause issues?
-        # Usually User-Agent and Cookie are strict requirements for Terabox.
-        cleaned_headers = {k: v for k, v in headers.items() if k in ['User-Agent', 'Cookie', 'Referer']}
-        
+def serve_cached(entry, filename, request, received=None):
+    """Serves a proxy cache entry; one still being filled is streamed as it grows."""
+    if entry.complete:
+        # Protect the file from eviction while it streams
+        PROXY_CACHE.acquire(entry)
+        return MeteredFileResponse(entry.path, filename=filename, media_type="application/octet-stream",
+                                   release=partial(PROXY_CACHE.release, entry), kind="cache", received=received)
+
+    headers = {"Content-Disposition": f'attachment; filename="{filename}"', "Accept-Ranges": "bytes"}
+    span = parse_range(request.headers.get("Range"), entry.size)
+    if span is False:
+        return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{entry.size}"})
+    start, end = span or (0, entry.size - 1)
+    headers["Content-Length"] = str(end - start + 1)
+    if span:
+        headers["Content-Range"] = f"bytes {start}-{end}/{entry.size}"
+    status = 206 if span else 200
+    if request.method == "HEAD":
+        return Response(status_code=status, headers=headers, media_type="application/octet-stream")
+    return StreamingResponse(metered(PROXY_CACHE.read(entry, start, end), "cache", received), status_code=status,
+                             media_type="application/octet-stream", headers=headers)
+
+# Upper bound on files in one /api/zip archive
+ZIP_MAX_FILES = int(os.environ.get("ZIP_MAX_FILES", "500"))
+
+@app.get("/api/zip")
+async def download_zip(ids: str, name: str = "download"):
+    """
+    Streams several fileIds (resolved links and/or processed outputs) as one stored ZIP64
+    archive, built on the fly. Content-Length is sent when every member size is known.
+    """
+    file_ids = [i for i in ids.split(",") if i]
+    if not file_ids:
+        raise HTTPException(status_code=400, detail="No fileIds given")
+    if len(file_ids) > ZIP_MAX_FILES:
+        raise HTTPException(status_code=400, detail=f"At most {ZIP_MAX_FILES} files per archive")
+
+    sources = []
+    local, cached_entries = [], []
+    for file_id in file_ids:
+        entry = FILE_INDEX.get(file_id)
+        if entry and not os.path.exists(entry.path):
+            # Removed behind the index's back
+            FILE_INDEX.discard(entry.filename)
+            entry = None
+        record = None if entry else await FILE_CACHE.get(file_id)
+        if entry:
+            local.append(entry.filename)
+            sources.append((entry.filename, entry.size, lambda entry=entry: local_body(entry)))
+        elif record and record.url:
+            # Resolvers report 0 when the size is unknown
+            size = record.size or None
+            cached = PROXY_CACHE.get(upstream_key(record.url, record.size))
+            if cached:
+                cached_entries.append(cached)
+                sources.append((record.filename, cached.size,
+                                lambda cached=cached: PROXY_CACHE.read(cached, 0, cached.size - 1)))
+                continue
+            sources.append((record.filename, size,
+                            lambda file_id=file_id, record=record, size=size: upstream_body(file_id, record, size)))
+        else:
+            raise HTTPException(status_code=404, detail=f"File link expired or invalid: {file_id}")
+
+    names = unique_names([source[0] for source in sources])
+    members = [ZipMember(n, size, open_body) for n, (_, size, open_body) in zip(names, sources)]
+    print(f"Streaming zip of {len(members)} files")
+
+    # Every member on disk is protected from eviction until the whole archive is sent,
+    # not only once it is reached: Content-Length already counts on it
+    for filename in local:
+        JANITOR.acquire(filename)
+    for cached in cached_entries:
+        PROXY_CACHE.hold(cached)
+
+    def release_members():
+        for filename in local:
+            JANITOR.release(filename)
+        for cached in cached_entries:
+            PROXY_CACHE.release(cached)
+
+    headers = {"Content-Disposition": f'attachment; filename="{name}.zip"'}
+    total = zip_size(members)
+    if total is not None:
+        headers["Content-Length"] = str(total)
+    return ReleasingStreamingResponse(metered(stream_zip(members), "zip"), release=release_members,
+                                      media_type="application/zip", headers=headers)
+
+async def local_body(entry):
+    with open(entry.path, "rb") as f:
+        while True:
+            chunk = await asyncio.to_thread(f.read, 1024 * 1024)
+            if not chunk:
+                break
+            yield chunk
+
+async def upstream_body(file_id, record, size=None):
+    resp, record = await open_record(file_id, record, dict(record.headers))
+    if resp.status != 200:
+        resp.release()
+        raise RuntimeError(f"Upstream returned {resp.status} for {record.filename}")
+    if size is not None and resp.content_length is not None and resp.content_length != size:
+        resp.release()
+        raise RuntimeError(f"Upstream size changed for {record.filename}")
+    async for chunk in proxy_download(resp, file_id, record, dict(record.headers)):
+        yield chunk
+
+async def open_upstream(url, headers):
+    """Opens the upstream download on the shared session; the caller must release the response."""
+    session = await HTTP_CLIENT.session()
+    try:
+        resp = await session.get(url, headers=headers)
+    except Exception as e:
+        UPSTREAM_ERRORS.inc(type(e).__name__)
+        raise
+    if resp.status >= 400:
+        UPSTREAM_ERRORS.inc(str(resp.status))
+    return resp
+
+class StreamMeter:
+    """
+    Counts one response body: active streams, bytes sent, throughput and (from
+    `received`, the request's perf_counter) time to first byte.
+    """
+
+    def __init__(self, kind, received=None):
+        self.kind = kind
+        self.received = received
+        self.sent_bytes = PROXY_BYTES.labels(kind)
+        self.active = ACTIVE_STREAMS.labels(kind)
+        self.sent = 0
+        self.active.inc()
+        self.started = time.perf_counter()
+
+    def count(self, nbytes):
+        if not self.sent and self.received is not None:
+            PROXY_TTFB_SECONDS.observe(time.perf_counter() - self.received, self.kind)
+        self.sent += nbytes
+        self.sent_bytes.inc(nbytes)
+
+    def close(self):
+        self.active.dec()
+        elapsed = time.perf_counter() - self.started
+        if self.sent and elapsed > 0:
+            PROXY_THROUGHPUT.observe(self.sent / elapsed, self.kind)
+
+async def metered(body, kind, received=None):
+    """Relays a response body while counting it (see StreamMeter)."""
+    meter = StreamMeter(kind, received)
+    try:
+        async for chunk in body:
+            meter.count(len(chunk))
+            yield chunk
+    finally:
+        meter.close()
+
+class MeteredFileResponse(FileResponse):
+    """
+    FileResponse counted like metered() bodies. `release()` runs however the response
+    ends: unlike `background`, also after a 416 or 400 for a bad Range.
+    """
+
+    def __init__(self, *args, kind, received=None, release=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.kind = kind
+        self.received = received
+        self.release = release
+
+    async def __call__(self, scope, receive, send):
+        meter = StreamMeter(self.kind, self.received)
+
+        async def counting_send(message):
+            if message["type"] == "http.response.body" and message.get("body"):
+                meter.count(len(message["body"]))
+            elif message["type"] == "http.response.pathsend":
+                # The server sends the whole file itself
+                meter.count(int(self.headers.get("content-length", 0)))
+            await send(message)
+
         try:
-            async with session.get(url, headers=cleaned_headers) as resp:
-                if resp.status != 200:
-                    print(f"Upstream error: {resp.status}")
-                    yield b"" # Close stream effectively
-                    return
+            await super().__call__(scope, receive, counting_send)
+        finally:
+            meter.close()
+            if self.release:
+                self.release()
+
+class ReleasingStreamingResponse(StreamingResponse):
+    """
+    StreamingResponse whose `release()` runs however the response ends, also when the
+    client is gone before the body is started (its generator's finally would never run).
+    """
+
+    def __init__(self, *args, release, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.release = release
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.release()
 
+# Mid-stream recovery (overridable from the environment)
+PROXY_RESUME_RETRIES = int(os.environ.get("PROXY_RESUME_RETRIES", "3"))  # Reconnects per proxied download
+# Upstream statuses meaning the signed link itself was rejected
+LINK_REJECTED = (403, 410)
+
+async def refresh_record(file_id, record):
+    """
+    Re-resolves the share/page a FILE_CACHE record came from, with the cookie it was first
+    resolved with, and stores the fresh link under the same fileId. Returns the new record,
+    or None when it cannot be refreshed.
+    """
+    if not record.source_url:
+        return None
+    print(f"Refreshing expired link for {file_id} from {record.source_url}")
+    result = await UniversalDownloader.refresh(record.source_url, record.url, record.cookie)
+    if "error" in result:
+        print(f"Link refresh failed: {result['error']}")
+        return None
+    url, size = result.get("url"), result.get("size")
+    for entry in result.get("files") or []:
+        if (entry.get("path") or entry["filename"]) == (record.path or record.filename):
+            url, size = entry["url"], entry["size"]
+            break
+    if not url or (record.size and size and record.size != size):
+        # Not the same file anymore
+        return None
+    return await FILE_CACHE.put(file_id, url, record.filename, record.size, result.get("headers"),
+                                record.source_url, record.path, record.cookie)
+
+async def open_record(file_id, record, headers):
+    """
+    Opens a FILE_CACHE record upstream; a link that has expired or is rejected is refreshed
+    once first. Returns (response, record actually used); the caller must release the response.
+    """
+    expiry = link_expiry(record.url)
+    if expiry and expiry <= time.time():
+        record = await refresh_record(file_id, record) or record
+    resp = await open_upstream(record.url, {**headers, **record.headers})
+    if resp.status in LINK_REJECTED:
+        fresh = await refresh_record(file_id, record)
+        if fresh:
+            resp.release()
+            record = fresh
+            resp = await open_upstream(record.url, {**headers, **record.headers})
+    return resp, record
+
+def record_opener(file_id, record):
+    """open_record for one fileId that keeps using the latest link once it has been refreshed."""
+    async def reopen(headers):
+        nonlocal record
+        resp, record = await open_record(file_id, record, headers)
+        return resp
+    return reopen
+
+def _body_span(resp):
+    """(first byte, last byte or None) of what an upstream response body covers."""
+    if resp.status == 206:
+        parsed = parse_content_range(resp.headers.get("Content-Range"))
+        if parsed:
+            return parsed[0], parsed[1]
+    if resp.content_length is not None and not resp.headers.get("Content-Encoding"):
+        return 0, resp.content_length - 1
+    return 0, None
+
+async def proxy_download(resp, file_id=None, record=None, headers=None):
+    """
+    Relays an upstream body. For a FILE_CACHE record, a connection that drops or a link
+    that expires mid-stream is picked up again with a Range request from the byte offset
+    already sent (refreshing the link if needed), so the client sees one unbroken stream.
+    """
+    offset, end = _body_span(resp)
+    # Resumed ranges must come from the same version of the file
+    validator = resp.headers.get("ETag") or resp.headers.get("Last-Modified")
+    retries = 0
+    try:
+        while True:
+            try:
+                if resp is None:
+                    resp, record = await resume_upstream(file_id, record, headers, offset, end, validator)
                 async for chunk in resp.content.iter_chunked(1024 * 1024): # 1MB chunks for better throughput
+                    offset += len(chunk)
                     yield chunk
-        except Exception as e:
-            print(f"Proxy download error: {e}")
-            yield b""
+                if end is None or offset > end:
+                    return
+                raise aiohttp.ClientPayloadError(f"Upstream closed at byte {offset} of {end + 1}")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                print(f"Proxy download error: {e}")
+                UPSTREAM_ERRORS.inc(type(e).__name__)
+                if record is None or end is None or retries >= PROXY_RESUME_RETRIES:
+                    raise
+            if resp is not None:
+                resp.release()
+                resp = None
+            retries += 1
+            await asyncio.sleep(0.5 * retries)
+    finally:
+        if resp is not None:
+            resp.release()
 
-if __name__ == "__main__":
-    if not os.path.exists("downloads"):
-        os.makedirs("downloads")
-    
-    # Clean up old partial downloads on startup
-    for f in os.listdir("downloads"):
-        if f.endswith(".part"):
-            try:
-                os.remove(os.path.join("downloads", f))
-            except: pass
+async def resume_upstream(file_id, record, headers, offset, end, validator=None):
+    """
+    Re-opens a record at `offset`; raises when the upstream cannot continue there. With
+    If-Range, a file that changed since `validator` comes back whole (200) and is refused.
+    """
+    print(f"Resuming {file_id} at byte {offset}")
+    range_headers = {k: v for k, v in headers.items() if k not in RANGE_HEADERS}
+    range_headers["Range"] = f"bytes={offset}-{end}"
+    if validator:
+        range_headers["If-Range"] = validator
+    resp, record = await open_record(file_id, record, range_headers)
+    span = parse_content_range(resp.headers.get("Content-Range")) if resp.status == 206 else None
+    if not span or span[0] != offset:
+        resp.release()
+        raise aiohttp.ClientPayloadError(f"Upstream cannot resume at byte {offset} (status {resp.status})")
+    return resp, record
 
+if __name__ == "__main__":
+    # Partial downloads are cleaned up by the janitor started in the app lifespan
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,194 @@
+import bisect
+import time
+from contextlib import contextmanager
+
+# Prometheus text exposition, kept dependency-free: hot paths only do a dict lookup
+# and a few integer/float adds per observation (bind labels once with `.labels()`
+# where an observation repeats, e.g. per chunk).
+
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 45, 90, 180)
+JOB_BUCKETS = (0.1, 0.5, 1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600)
+THROUGHPUT_BUCKETS = tuple(2 ** n * 1024 for n in range(6, 21, 2))  # 64 KiB/s .. 1 GiB/s
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=""):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._children = {}
+        REGISTRY.append(self)
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._child()
+        return child
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in list(self._children.items()):
+            lines.extend(self._render_child(values, child))
+        return lines
+
+
+class _Value:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+
+class Counter(_Metric):
+    kind = "counter"
+    _child = _Value
+
+    def inc(self, *values, amount=1):
+        self.labels(*values).value += amount
+
+    def _render_child(self, values, child):
+        return [f"{self.name}{_labels(self.label_names, values)} {_number(child.value)}"]
+
+
+class Gauge(Counter):
+    """A value set by the code (`inc`/`dec`), or read from `callback()` at scrape time."""
+    kind = "gauge"
+
+    def __init__(self, name, help, labels=(), callback=None):
+        super().__init__(name, help, labels)
+        # callback() returns a number, or {label values tuple: number} for labelled gauges
+        self.callback = callback
+
+    def dec(self, *values, amount=1):
+        self.labels(*values).value -= amount
+
+    def render(self):
+        if self.callback:
+            try:
+                sampled = self.callback()
+            except Exception as e:
+                print(f"Metrics: {self.name} callback failed: {e}")
+                sampled = {}
+            if not isinstance(sampled, dict):
+                sampled = {(): sampled}
+            for values, value in sampled.items():
+                self.labels(*values).value = value
+        return super().render()
+
+
+class _Buckets:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self, size):
+        self.counts = [0] * size
+        self.sum = 0.0
+        self.count = 0
+
+
+class _HistogramChild:
+    __slots__ = ("bounds", "data")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.data = _Buckets(len(bounds) + 1)
+
+    def observe(self, value):
+        data = self.data
+        data.counts[bisect.bisect_left(self.bounds, value)] += 1
+        data.sum += value
+        data.count += 1
+
+    @contextmanager
+    def time(self):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.bounds = tuple(sorted(buckets))
+        super().__init__(name, help, labels)
+
+    def _child(self):
+        return _HistogramChild(self.bounds)
+
+    def observe(self, value, *values):
+        self.labels(*values).observe(value)
+
+    def time(self, *values):
+        return self.labels(*values).time()
+
+    def _render_child(self, values, child):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.bounds + (float("inf"),), child.data.counts):
+            cumulative += count
+            le = 'le="%s"' % _number(bound if bound == float("inf") else float(bound))
+            lines.append(f"{self.name}_bucket{_labels(self.label_names, values, le)} {cumulative}")
+        lines.append(f"{self.name}_sum{_labels(self.label_names, values)} {_number(child.data.sum)}")
+        lines.append(f"{self.name}_count{_labels(self.label_names, values)} {child.data.count}")
+        return lines
+
+
+REGISTRY = []
+
+
+def render():
+    """Every registered metric in the Prometheus text format."""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# Resolving
+RESOLVE_SECONDS = Histogram("fetchit_resolve_seconds", "Resolve duration by handler", ["handler"])
+RESOLVES = Counter("fetchit_resolves_total", "Resolves by handler and outcome", ["handler", "outcome"])
+BROWSER_LAUNCH_SECONDS = Histogram("fetchit_browser_launch_seconds", "Chromium launch duration")
+PAGE_NAVIGATION_SECONDS = Histogram("fetchit_page_navigation_seconds", "Share page navigation duration by mirror",
+                                    ["mirror", "outcome"])
+
+# Proxying
+PROXY_BYTES = Counter("fetchit_proxy_bytes_total", "Bytes sent to clients by kind of stream", ["kind"])
+PROXY_THROUGHPUT = Histogram("fetchit_proxy_throughput_bytes_per_second", "Throughput of finished proxied downloads",
+                             ["kind"], buckets=THROUGHPUT_BUCKETS)
+PROXY_TTFB_SECONDS = Histogram("fetchit_proxy_ttfb_seconds", "Time from download request to first body byte",
+                               ["kind"])
+ACTIVE_STREAMS = Gauge("fetchit_active_streams", "Downloads currently streaming", ["kind"])
+UPSTREAM_ERRORS = Counter("fetchit_upstream_errors_total", "Upstream error statuses and exceptions", ["code"])
+
+# Processing
+JOB_QUEUE_WAIT_SECONDS = Histogram("fetchit_job_queue_wait_seconds", "Time a /api/process job waited for a worker",
+                                   buckets=JOB_BUCKETS)
+JOB_MERGE_SECONDS = Histogram("fetchit_job_merge_seconds", "Duration of the merge step of a job", buckets=JOB_BUCKETS)
+JOB_SECONDS = Histogram("fetchit_job_seconds", "Duration of a job by outcome", ["outcome"], buckets=JOB_BUCKETS)
@@ -0,0 +1,248 @@
+import asyncio
+import os
+import time
+from collections import deque
+from urllib.parse import urlparse, urlunparse
+
+# Terabox mirror tuning (overridable from the environment)
+TERABOX_MIRRORS = [d.strip() for d in os.environ.get(
+    "TERABOX_MIRRORS", "1024tera.com,terabox.com,teraboxapp.com").split(",") if d.strip()]
+MIRROR_HEDGE_MIN = float(os.environ.get("MIRROR_HEDGE_MIN", "0.5"))  # Bounds of the adaptive hedge deadline
+MIRROR_HEDGE_MAX = float(os.environ.get("MIRROR_HEDGE_MAX", "5"))
+MIRROR_NAV_TIMEOUT = float(os.environ.get("MIRROR_NAV_TIMEOUT", "45"))  # Max seconds a browser navigation may take
+MIRROR_BREAKER_FAILURES = int(os.environ.get("MIRROR_BREAKER_FAILURES", "3"))  # Consecutive failures that open the breaker
+MIRROR_BREAKER_COOLDOWN = float(os.environ.get("MIRROR_BREAKER_COOLDOWN", "30"))  # Doubles while the mirror keeps failing
+MIRROR_BREAKER_MAX_COOLDOWN = 600
+MIRROR_WINDOW = 50  # Recent requests latency and success rate are computed over
+MIRROR_MIN_SAMPLES = 5  # Below this, the hedge deadline is MIRROR_HEDGE_MAX
+NAV_TIMEOUT_FACTOR = 4  # Navigation timeout as a multiple of the mirror's p90 latency
+NAV_TIMEOUT_MIN = 10
+HEDGE_FANOUT = 2  # Mirrors in flight at once for one request
+
+
+class MirrorError(Exception):
+    pass
+
+
+def mirror_url(url: str, domain: str):
+    """`url` with its Terabox host replaced by `domain` (a leading www. is kept)."""
+    parsed = urlparse(url)
+    host = parsed.netloc
+    www = "www." if host.lower().startswith("www.") else ""
+    return urlunparse(parsed._replace(netloc=www + domain))
+
+
+class MirrorHealth:
+    __slots__ = ("domain", "latencies", "recent", "streak", "opened_until", "cooldown", "probing",
+                 "requests", "successes", "failures", "opens")
+
+    def __init__(self, domain):
+        self.domain = domain
+        self.latencies = deque(maxlen=MIRROR_WINDOW)
+        self.recent = deque(maxlen=MIRROR_WINDOW)
+        self.streak = 0  # Consecutive failures
+        self.opened_until = 0.0
+        self.cooldown = MIRROR_BREAKER_COOLDOWN
+        self.probing = False  # A half-open trial request is in flight
+        self.requests = 0
+        self.successes = 0
+        self.failures = 0
+        self.opens = 0
+
+    @property
+    def success_rate(self):
+        # Untried mirrors count as healthy so they get picked
+        return sum(self.recent) / len(self.recent) if self.recent else 1.0
+
+    def percentile(self, q):
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def state(self, now):
+        if self.opened_until == 0.0:
+            return "closed"
+        return "open" if self.opened_until > now else "half_open"
+
+    def available(self, now):
+        state = self.state(now)
+        return state == "closed" or (state == "half_open" and not self.probing)
+
+    def stats(self, now):
+        p50, p90 = self.percentile(0.5), self.percentile(0.9)
+        return {
+            "domain": self.domain,
+            "state": self.state(now),
+            "requests": self.requests,
+            "successes": self.successes,
+            "failures": self.failures,
+            "success_rate": round(self.success_rate, 3),
+            "latency_p50": round(p50, 3) if p50 is not None else None,
+            "latency_p90": round(p90, 3) if p90 is not None else None,
+            "opens": self.opens,
+            "open_until": self.opened_until if self.opened_until > now else None,
+        }
+
+
+class MirrorSet:
+    """
+    The Terabox domains a share can be opened on, ranked by recent success rate and
+    latency. A request goes to the best mirror; if it has not answered by an adaptive
+    deadline (that mirror's p90 latency) a second mirror is tried alongside it, and the
+    first answer wins. A mirror that fails repeatedly is skipped until its cooldown
+    ends, then gets a single trial request before taking traffic again.
+    """
+
+    def __init__(self, domains=TERABOX_MIRRORS):
+        self.domains = list(domains)
+        self.health = {d: MirrorHealth(d) for d in self.domains}
+
+        # Stats
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.failovers = 0
+
+    def ranked(self):
+        """Mirrors to try, best first. When every breaker is open, the one reopening first."""
+        now = time.time()
+        available = [h for h in self.health.values() if h.available(now)]
+        if not available:
+            return [min(self.health.values(), key=lambda h: h.opened_until).domain]
+        # Success rate in steps of 10%, then median latency (untried mirrors first)
+        available.sort(key=lambda h: (-int(h.success_rate * 10), h.percentile(0.5) or 0.0))
+        return [h.domain for h in available]
+
+    def hedge_delay(self, domain):
+        health = self.health[domain]
+        if len(health.latencies) < MIRROR_MIN_SAMPLES:
+            return MIRROR_HEDGE_MAX
+        return min(MIRROR_HEDGE_MAX, max(MIRROR_HEDGE_MIN, health.percentile(0.9)))
+
+    def navigation_timeout(self, domain):
+        """Seconds a browser navigation to `domain` may take before moving on to another mirror."""
+        p90 = self.health[domain].percentile(0.9)
+        if p90 is None or len(self.health[domain].latencies) < MIRROR_MIN_SAMPLES:
+            return MIRROR_NAV_TIMEOUT
+        return min(MIRROR_NAV_TIMEOUT, max(NAV_TIMEOUT_MIN, p90 * NAV_TIMEOUT_FACTOR))
+
+    def begin(self, domain):
+        health = self.health[domain]
+        health.requests += 1
+        if health.state(time.time()) == "half_open":
+            health.probing = True
+
+    def success(self, domain, latency):
+        health = self.health[domain]
+        health.probing = False
+        health.successes += 1
+        health.streak = 0
+        health.recent.append(1)
+        health.latencies.append(latency)
+        if health.opened_until:
+            print(f"Mirror {domain}: recovered, closing breaker")
+        health.opened_until = 0.0
+        health.cooldown = MIRROR_BREAKER_COOLDOWN
+
+    def failure(self, domain):
+        health = self.health[domain]
+        now = time.time()
+        trial = health.probing
+        health.probing = False
+        health.failures += 1
+        health.streak += 1
+        health.recent.append(0)
+        if trial:
+            # Failed its trial request: back off for longer
+            health.cooldown = min(MIRROR_BREAKER_MAX_COOLDOWN, health.cooldown * 2)
+        if trial or (health.state(now) == "closed" and health.streak >= MIRROR_BREAKER_FAILURES):
+            health.opened_until = now + health.cooldown
+            health.opens += 1
+            print(f"Mirror {domain}: {health.streak} failures, breaker open for {int(health.cooldown)}s")
+
+    def release(self, domain, elapsed):
+        """The request on `domain` was abandoned after `elapsed` seconds (another mirror answered first)."""
+        health = self.health[domain]
+        health.probing = False
+        # Not an answer, but the mirror took at least this long: keeps a slow mirror ranked down
+        health.latencies.append(elapsed)
+
+    async def _attempt(self, attempt, url, domain):
+        self.begin(domain)
+        started = time.monotonic()
+        try:
+            result = await attempt(mirror_url(url, domain))
+        except asyncio.CancelledError:
+            self.release(domain, time.monotonic() - started)
+            raise
+        except Exception:
+            self.failure(domain)
+            raise
+        self.success(domain, time.monotonic() - started)
+        return result
+
+    async def race(self, url, attempt):
+        """
+        Runs `attempt(mirrored_url)` on the ranked mirrors and returns (result, domain) of
+        the first that does not raise; losing attempts are cancelled. A mirror is
+        hedged by the next one after its deadline, or replaced right away when it fails.
+        Raises MirrorError when every mirror failed.
+        """
+        candidates = deque(self.ranked())
+        pending = {}
+        hedges = set()
+        errors = []
+
+        def launch():
+            domain = candidates.popleft()
+            task = asyncio.ensure_future(self._attempt(attempt, url, domain))
+            pending[task] = domain
+            return task
+
+        try:
+            last = launch()
+            while pending:
+                hedge = candidates and len(pending) < HEDGE_FANOUT
+                timeout = self.hedge_delay(pending[last]) if hedge else None
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    self.hedged += 1
+                    slow = pending[last]
+                    last = launch()
+                    hedges.add(last)
+                    print(f"Mirror hedge: {slow} is slow, also trying {pending[last]}")
+                    continue
+                for task in done:
+                    domain = pending.pop(task)
+                    if task.exception() is None:
+                        if task in hedges:
+                            self.hedge_wins += 1
+                        return task.result(), domain
+                    errors.append(f"{domain}: {task.exception()}")
+                    if candidates:
+                        # Failed outright: its replacement starts now, not after a deadline
+                        self.failovers += 1
+                        last = launch()
+                        if task in hedges:
+                            hedges.add(last)
+                if last not in pending and pending:
+                    last = next(reversed(pending))
+            raise MirrorError("; ".join(errors) or "No mirror available")
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+
+    def stats(self):
+        now = time.time()
+        return {
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+            "failovers": self.failovers,
+            "mirrors": [h.stats(now) for h in self.health.values()],
+        }
+
+
+# Shared health of the Terabox mirrors, used by both the HTTP and the browser resolver
+MIRRORS = MirrorSet()
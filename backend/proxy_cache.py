@@ -0,0 +1,302 @@
+import asyncio
+import hashlib
+import json
+import os
+import re
+import time
+from urllib.parse import urlparse, parse_qsl
+
+# Proxy disk cache tuning (overridable from the environment)
+PROXY_CACHE_ENABLED = os.environ.get("PROXY_CACHE", "0") == "1"
+PROXY_CACHE_DIR = os.environ.get("PROXY_CACHE_DIR", "proxy_cache")
+PROXY_CACHE_MAX_BYTES = int(os.environ.get("PROXY_CACHE_MAX_BYTES", str(20 * 1024 ** 3)))
+PROXY_CACHE_MAX_FILE = int(os.environ.get("PROXY_CACHE_MAX_FILE", str(4 * 1024 ** 3)))  # Larger files are never cached
+PROXY_CACHE_MIN_FILE = int(os.environ.get("PROXY_CACHE_MIN_FILE", str(1024 * 1024)))  # Smaller ones are not worth it
+STALE_FILL_AGE = 600  # Seconds after which an unfinished file without a writer is removed
+READ_CHUNK = 1024 * 1024
+
+# Query params that identify the file behind a signed link (Terabox fid, googlevideo id/itag)
+IDENTITY_PARAMS = {"fid", "fs_id", "id", "itag"}
+# Query params that change with every signature of the same file
+VOLATILE_PARAMS = {"sign", "signature", "sig", "lsig", "time", "expires", "expire", "dstime", "rt", "sh", "vuk",
+                   "ip", "ei", "token", "policy", "key-pair-id", "x-amz-signature", "x-amz-date",
+                   "x-amz-credential", "x-amz-expires", "x-amz-security-token"}
+
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+class ProxyCacheError(Exception):
+    pass
+
+
+def upstream_key(url: str, size: int):
+    """
+    Cache key for the file behind a signed link: the same file resolved twice (new
+    fileId, new signature, another CDN host) maps to the same key. None when the
+    size is unknown.
+    """
+    if not url or not size:
+        return None
+    parsed = urlparse(url)
+    params = parse_qsl(parsed.query, keep_blank_values=True)
+    identity = sorted((k, v) for k, v in params if k.lower() in IDENTITY_PARAMS)
+    if identity:
+        # CDN hosts differ between resolves of the same file
+        source = f"{parsed.path}?{identity}"
+    else:
+        kept = sorted((k, v) for k, v in params if k.lower() not in VOLATILE_PARAMS)
+        source = f"{parsed.netloc}{parsed.path}?{kept}"
+    return hashlib.sha1(f"{source}|{size}".encode()).hexdigest()[:32]
+
+
+def parse_range(header: str, size: int):
+    """
+    (start, end) of a single-range `Range` header, None to serve the whole file,
+    or False when the range cannot be satisfied.
+    """
+    match = RANGE_RE.match((header or "").strip())
+    if not match or not any(match.groups()):
+        return None
+    first, last = match.groups()
+    if not first:
+        # Suffix range: the last N bytes
+        return (max(0, size - int(last)), size - 1) if int(last) else False
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or end < start:
+        return False
+    return start, end
+
+
+def _write(f, chunk):
+    f.write(chunk)
+    # Readers following the fill read the file directly
+    f.flush()
+
+
+class CacheEntry:
+    __slots__ = ("key", "path", "size", "written", "complete", "failed", "readers", "last_used", "changed", "task")
+
+    def __init__(self, key, path, size, complete=False, last_used=None):
+        self.key = key
+        self.path = path
+        self.size = size
+        self.written = size if complete else 0
+        self.complete = complete
+        self.failed = False
+        self.readers = 0
+        self.last_used = last_used or time.time()
+        self.changed = asyncio.Condition() if not complete else None
+        self.task = None
+
+
+class ProxyCache:
+    """
+    Disk copies of proxied downloads, keyed by upstream file identity rather than fileId.
+    The first full download of a file is written to disk by a background fill while
+    it streams; requests arriving meanwhile read the same growing file instead of
+    opening their own upstream connection, and later ones are served from disk with
+    range support. Least recently used files are evicted to stay within `max_bytes`.
+    A file is complete once its `<key>.json` sidecar exists, so several workers can
+    share the directory (a file being filled by one is skipped by the others).
+    """
+
+    def __init__(self, directory: str = PROXY_CACHE_DIR, max_bytes: int = PROXY_CACHE_MAX_BYTES,
+                 enabled: bool = PROXY_CACHE_ENABLED):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.entries = {}
+
+        # Stats
+        self.hits = 0
+        self.follows = 0
+        self.fills = 0
+        self.fill_failures = 0
+        self.evicted = 0
+
+    def _paths(self, key):
+        base = os.path.join(self.directory, key)
+        return base, base + ".json"
+
+    async def start(self):
+        if self.enabled:
+            await asyncio.to_thread(self._scan)
+
+    def _scan(self):
+        """Indexes finished files and removes fills abandoned by a crashed worker."""
+        os.makedirs(self.directory, exist_ok=True)
+        now = time.time()
+        with os.scandir(self.directory) as it:
+            names = {e.name: e for e in it if e.is_file()}
+        for name, item in names.items():
+            if name.endswith(".json"):
+                continue
+            if name + ".json" in names:
+                stat = item.stat()
+                self.entries[name] = CacheEntry(name, item.path, stat.st_size, complete=True, last_used=stat.st_atime)
+            elif now - item.stat().st_mtime > STALE_FILL_AGE:
+                os.remove(item.path)
+        print(f"Proxy cache: {len(self.entries)} files on disk")
+
+    async def stop(self):
+        fills = [e.task for e in self.entries.values() if e.task]
+        for task in fills:
+            task.cancel()
+        await asyncio.gather(*fills, return_exceptions=True)
+
+    def get(self, key):
+        """Entry for `key` that can be read now (finished or being filled), or None."""
+        if not self.enabled or not key:
+            return None
+        entry = self.entries.get(key)
+        if entry is None:
+            path, meta = self._paths(key)
+            if not os.path.exists(meta):
+                return None
+            # Filled by another worker sharing the directory
+            try:
+                entry = CacheEntry(key, path, os.path.getsize(path), complete=True)
+            except OSError:
+                return None
+            self.entries[key] = entry
+        elif entry.complete and not os.path.exists(entry.path):
+            # Evicted by another worker
+            del self.entries[key]
+            return None
+        return None if entry.failed else entry
+
+    def fill(self, key, size, body):
+        """
+        Starts writing `body` (an async iterator of the whole file) to disk in the
+        background and returns its entry, or None when the file is not cached
+        (disabled, out of bounds, no room, or another worker is already filling it).
+        """
+        if not self.enabled or not key or key in self.entries:
+            return None
+        if not PROXY_CACHE_MIN_FILE <= size <= min(PROXY_CACHE_MAX_FILE, self.max_bytes):
+            return None
+        if not self._make_room(size):
+            return None
+        path, _ = self._paths(key)
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except OSError:
+            return None
+        entry = CacheEntry(key, path, size)
+        self.entries[key] = entry
+        entry.task = asyncio.create_task(self._fill(entry, fd, body))
+        self.fills += 1
+        return entry
+
+    async def _fill(self, entry, fd, body):
+        try:
+            with os.fdopen(fd, "wb") as f:
+                async for chunk in body:
+                    await asyncio.to_thread(_write, f, chunk)
+                    entry.written += len(chunk)
+                    await self._notify(entry)
+                    if entry.written > entry.size:
+                        break
+            if entry.written != entry.size:
+                raise ProxyCacheError(f"expected {entry.size} bytes, got {entry.written}")
+            with open(self._paths(entry.key)[1], "w") as f:
+                json.dump({"size": entry.size, "filled_at": time.time()}, f)
+            entry.complete = True
+            print(f"Proxy cache: stored {entry.key} ({entry.size} bytes)")
+        except BaseException as e:
+            print(f"Proxy cache: fill of {entry.key} failed: {e!r}")
+            self.fill_failures += 1
+            entry.failed = True
+            self._remove(entry)
+            if not isinstance(e, Exception):
+                raise
+        finally:
+            entry.task = None
+            await self._notify(entry)
+
+    async def _notify(self, entry):
+        async with entry.changed:
+            entry.changed.notify_all()
+
+    def _remove(self, entry):
+        if self.entries.get(entry.key) is entry:
+            del self.entries[entry.key]
+        for path in self._paths(entry.key):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _make_room(self, size):
+        used = sum(e.size for e in self.entries.values())
+        if used + size <= self.max_bytes:
+            return True
+        idle = sorted((e for e in self.entries.values() if e.complete and not e.readers), key=lambda e: e.last_used)
+        for entry in idle:
+            self._remove(entry)
+            self.evicted += 1
+            used -= entry.size
+            if used + size <= self.max_bytes:
+                return True
+        return False
+
+    def acquire(self, entry):
+        """Protects an entry from eviction while it is served."""
+        if entry.complete:
+            self.hits += 1
+        else:
+            self.follows += 1
+        self.hold(entry)
+
+    def hold(self, entry):
+        """Protects an entry from eviction without counting it as served (pair with `release`)."""
+        entry.readers += 1
+        entry.last_used = time.time()
+
+    def release(self, entry):
+        entry.readers -= 1
+
+    async def read(self, entry, start, end):
+        """Yields bytes start..end of an entry, waiting for a fill in progress to write them."""
+        self.acquire(entry)
+        try:
+            fd = await asyncio.to_thread(os.open, entry.path, os.O_RDONLY)
+            try:
+                pos = start
+                while pos <= end:
+                    available = entry.size if entry.complete else entry.written
+                    if pos < available:
+                        n = min(READ_CHUNK, available - pos, end + 1 - pos)
+                        chunk = await asyncio.to_thread(os.pread, fd, n, pos)
+                        if not chunk:
+                            raise ProxyCacheError(f"{entry.key} is shorter than expected")
+                        pos += len(chunk)
+                        yield chunk
+                        continue
+                    if entry.failed:
+                        raise ProxyCacheError(f"Fill of {entry.key} failed")
+                    async with entry.changed:
+                        await entry.changed.wait_for(lambda: entry.written > pos or entry.failed or entry.complete)
+            finally:
+                os.close(fd)
+        finally:
+            self.release(entry)
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "entries": len(self.entries),
+            "filling": sum(1 for e in self.entries.values() if not e.complete),
+            "bytes": sum(e.written for e in self.entries.values()),
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "follows": self.follows,
+            "fills": self.fills,
+            "fill_failures": self.fill_failures,
+            "evicted": self.evicted,
+        }
+
+
+# Shared disk cache of proxied downloads (PROXY_CACHE=1 enables it)
+PROXY_CACHE = ProxyCache()
@@ -0,0 +1,146 @@
+import asyncio
+import os
+from universal_downloader import UniversalDownloader, DOWNLOAD_DIR, OUTPUT_CONTAINER
+from file_index import FILE_INDEX
+from ytdlp_pool import YTDLP_POOL, YTDLP_EXTRACT_TIMEOUT
+
+# Streaming remux tuning (overridable from the environment)
+FFMPEG_BINARY = os.environ.get("FFMPEG_BINARY", "ffmpeg")
+STREAM_CONCURRENCY = int(os.environ.get("STREAM_CONCURRENCY", "8"))  # Concurrent ffmpeg remux streams
+STREAM_CHUNK_SIZE = 256 * 1024
+STDERR_TAIL = 16 * 1024  # Bytes of ffmpeg's stderr kept for error messages
+
+# Fragmented MP4 can be written to a pipe: no seeking back to patch the moov atom
+FRAGMENTED_MP4_FLAGS = "frag_keyframe+empty_moov+default_base_moof"
+
+_slots = asyncio.Semaphore(STREAM_CONCURRENCY)
+_teeing = set()  # Output keys currently being written to disk by a stream
+
+
+class RemuxError(Exception):
+    pass
+
+
+def active_keys():
+    """Output keys whose `.stream.part` file a stream is writing (kept by the janitor)."""
+    return list(_teeing)
+
+
+async def _read_stderr(stream):
+    """Reads ffmpeg's stderr as it comes (a full, unread pipe would stall ffmpeg); returns its tail."""
+    tail = b""
+    while True:
+        chunk = await stream.read(4096)
+        if not chunk:
+            return tail.decode(errors="replace").strip()
+        tail = (tail + chunk)[-STDERR_TAIL:]
+
+
+async def _select_formats(url, format_selector):
+    opts = {'format': format_selector, 'quiet': True, 'no_warnings': True}
+    info = await YTDLP_POOL.run("extract", url, opts, timeout=YTDLP_EXTRACT_TIMEOUT)
+    return info, info.get('requested_formats') or [info]
+
+
+def ffmpeg_command(formats):
+    """ffmpeg remux of the selected video (+ audio) inputs into fragmented MP4 on stdout."""
+    cmd = [FFMPEG_BINARY, "-hide_banner", "-loglevel", "error", "-nostdin"]
+    for fmt in formats:
+        headers = fmt.get('http_headers') or {}
+        if headers:
+            cmd += ["-headers", "".join(f"{k}: {v}\r\n" for k, v in headers.items())]
+        cmd += ["-i", fmt['url']]
+    if len(formats) > 1:
+        cmd += ["-map", "0:v:0", "-map", "1:a:0"]
+    cmd += ["-c", "copy", "-movflags", FRAGMENTED_MP4_FLAGS, "-f", "mp4", "pipe:1"]
+    return cmd
+
+
+async def open_remux_stream(url: str, format_id: str, save: bool = False):
+    """
+    Starts an ffmpeg remux of the format selected for `format_id` (plus best audio)
+    and returns (filename, body iterator). Bytes are produced while the source is
+    still downloading. With `save`, a copy is written to disk under the same
+    content-addressed id /api/process uses, so later requests are served locally.
+    Raises RemuxError when ffmpeg cannot produce any output.
+    """
+    format_selector = UniversalDownloader.format_selector(format_id)
+    output_key = UniversalDownloader.output_key(url, format_selector)
+
+    await _slots.acquire()
+    proc = None
+    try:
+        info, formats = await _select_formats(url, format_selector)
+
+        proc = await asyncio.create_subprocess_exec(
+            *ffmpeg_command(formats),
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        stderr = asyncio.create_task(_read_stderr(proc.stderr))
+        # Fail with a proper error instead of an empty 200 when ffmpeg cannot start
+        first = await proc.stdout.read(STREAM_CHUNK_SIZE)
+        if not first:
+            await proc.wait()
+            raise RemuxError(await stderr or f"ffmpeg exited with {proc.returncode}")
+    except Exception:
+        if proc and proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        _slots.release()
+        raise
+
+    title = info.get('title') or 'download'
+    filename = f"{title}.{OUTPUT_CONTAINER}"
+    tee = save and output_key not in _teeing and not FILE_INDEX.get(output_key)
+    if tee:
+        _teeing.add(output_key)
+    return filename, _pump(proc, stderr, first, output_key if tee else None)
+
+
+async def _pump(proc, stderr, first, output_key):
+    final_path = part_path = sink = None
+    completed = False
+    try:
+        if output_key:
+            final_path = os.path.join(DOWNLOAD_DIR, f"{output_key}.{OUTPUT_CONTAINER}")
+            part_path = os.path.join(DOWNLOAD_DIR, f"{output_key}.stream.part")
+            os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+            sink = open(part_path, "wb")
+        chunk = first
+        while chunk:
+            if sink:
+                await asyncio.to_thread(sink.write, chunk)
+            yield chunk
+            chunk = await proc.stdout.read(STREAM_CHUNK_SIZE)
+        completed = await proc.wait() == 0
+        if not completed:
+            print(f"Remux stream failed: {await stderr}")
+    finally:
+        try:
+            if proc.returncode is None:
+                # Client went away: stop downloading
+                proc.kill()
+                await proc.wait()
+            if sink:
+                sink.close()
+                _keep_output(part_path, final_path, completed)
+        finally:
+            _teeing.discard(output_key)
+            _slots.release()
+
+
+def _keep_output(part_path, final_path, completed):
+    """Moves a fully written stream copy into place, or removes an incomplete one."""
+    if completed:
+        try:
+            os.replace(part_path, final_path)
+            FILE_INDEX.add(final_path)
+            print(f"Saved streamed output: {final_path}")
+            return
+        except OSError as e:
+            print(f"Could not save streamed output {final_path}: {e}")
+    try:
+        os.remove(part_path)
+    except OSError:
+        pass
@@ -0,0 +1,164 @@
+import asyncio
+import hashlib
+import os
+import re
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse, parse_qsl, urlencode, urlunparse
+from scraper import is_terabox_url, normalize_terabox_url
+
+# Cache tuning (overridable from the environment)
+RESOLVE_CACHE_TTL = float(os.environ.get("RESOLVE_CACHE_TTL", "600"))  # Upper bound for successful results
+RESOLVE_CACHE_ERROR_TTL = float(os.environ.get("RESOLVE_CACHE_ERROR_TTL", "30"))
+RESOLVE_CACHE_MAX_ENTRIES = int(os.environ.get("RESOLVE_CACHE_MAX_ENTRIES", "2000"))
+LINK_EXPIRY_MARGIN = 60  # Stop serving a cached link this many seconds before it expires
+
+# Query params that never change what a URL resolves to
+TRACKING_PARAMS = {"si", "feature", "fbclid", "gclid", "igshid"}
+
+DURATION_RE = re.compile(r"^(\d+)([smhd]?)$")
+DURATION_UNITS = {"": 1, "s": 1, "m": 60, "h": 3600, "d": 86400}
+
+
+def canonical_url(url: str):
+    """
+    Canonical form of a share/media URL for cache lookups.
+    Terabox mirrors collapse onto the same domain the scraper navigates to.
+    """
+    url = url.strip()
+    if is_terabox_url(url):
+        url = normalize_terabox_url(url)
+
+    parsed = urlparse(url)
+    host = parsed.netloc.lower()
+    if host.startswith("www."):
+        host = host[4:]
+    query = [(k, v) for k, v in parse_qsl(parsed.query, keep_blank_values=True)
+             if k not in TRACKING_PARAMS and not k.startswith("utm_")]
+    path = parsed.path.rstrip("/") or "/"
+    return urlunparse((parsed.scheme.lower() or "https", host, path, "", urlencode(sorted(query)), ""))
+
+
+def cache_key(url: str, cookie: str = None):
+    # The cookie changes what a link resolves to (e.g. LOGIN_REQUIRED), so it is part of the key
+    cookie_hash = hashlib.sha1(cookie.encode()).hexdigest()[:12] if cookie else ""
+    return f"{canonical_url(url)}|{cookie_hash}"
+
+
+def link_expiry(url: str):
+    """
+    Returns the unix time a signed link expires at, or None if unknown.
+    Understands YouTube style `expire=<unix>` and Terabox style `time=<unix>&expires=8h`.
+    """
+    if not url:
+        return None
+    params = dict(parse_qsl(urlparse(url).query))
+    try:
+        if "expire" in params:
+            return int(params["expire"])
+        if "expires" in params and "time" in params:
+            match = DURATION_RE.match(params["expires"].lower())
+            if match:
+                return int(params["time"]) + int(match.group(1)) * DURATION_UNITS[match.group(2)]
+    except ValueError:
+        pass
+    return None
+
+
+def result_urls(result):
+    """Every link a resolve result carries."""
+    return [result.get("url")] + [f.get("url") for f in result.get("formats") or []] \
+        + [f.get("url") for f in result.get("files") or []]
+
+
+def result_ttl(result):
+    """TTL for a resolve result, bounded by the earliest expiry of any link it carries."""
+    if "error" in result:
+        return RESOLVE_CACHE_ERROR_TTL
+
+    expiries = [e for e in (link_expiry(u) for u in result_urls(result)) if e]
+    ttl = RESOLVE_CACHE_TTL
+    if expiries:
+        ttl = min(ttl, min(expiries) - time.time() - LINK_EXPIRY_MARGIN)
+    return max(ttl, 0)
+
+
+class ResolveCache:
+    """
+    TTL cache for resolve results with single-flight deduplication:
+    concurrent lookups of the same key share one in-flight resolution.
+    """
+
+    def __init__(self, max_entries: int = RESOLVE_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (expires_at, result)
+        self._inflight = {}
+
+        # Stats
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.error_hits = 0
+
+    async def get_or_resolve(self, key, resolver):
+        """Returns the cached result for `key`, or awaits `resolver()` once for all concurrent callers."""
+        entry = self._entries.get(key)
+        if entry:
+            expires_at, result = entry
+            if expires_at > time.monotonic():
+                self.hits += 1
+                if "error" in result:
+                    self.error_hits += 1
+                self._entries.move_to_end(key)
+                return result
+            del self._entries[key]
+
+        task = self._inflight.get(key)
+        if task:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            task = asyncio.ensure_future(self._run(key, resolver))
+            self._inflight[key] = task
+
+        # Shield so one disconnecting client does not cancel the resolve for everyone else
+        return await asyncio.shield(task)
+
+    def invalidate(self, key, stale_url=None):
+        """
+        Drops the cached result for `key`. With `stale_url`, only a result that still
+        carries that link is dropped (another caller may have refreshed it already).
+        """
+        entry = self._entries.get(key)
+        if entry and (stale_url is None or stale_url in result_urls(entry[1])):
+            del self._entries[key]
+
+    async def _run(self, key, resolver):
+        try:
+            result = await resolver()
+            ttl = result_ttl(result)
+            if ttl > 0:
+                self._entries[key] = (time.monotonic() + ttl, result)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+            return result
+        finally:
+            self._inflight.pop(key, None)
+
+    def stats(self):
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "inflight": len(self._inflight),
+            "hits": self.hits,
+            "error_hits": self.error_hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "hit_ratio": round((self.hits + self.coalesced) / lookups, 3) if lookups else 0.0,
+        }
+
+
+# Shared cache used by UniversalDownloader.resolve
+RESOLVE_CACHE = ResolveCache()
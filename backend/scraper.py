@@ -1,7 +1,9 @@
 import random
 import time
 import asyncio
-from playwright.async_api import async_playwright
+from browser_pool import BROWSER_POOL
+from mirrors import MIRRORS, TERABOX_MIRRORS, mirror_url
+from metrics import PAGE_NAVIGATION_SECONDS
 
 UA_LIST = [
     "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
@@ -10,70 +12,135 @@ UA_LIST = [
     "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
 ]
 
+TERABOX_MARKERS = ["terabox", "1024tera", "terashare", "miracledown", "teraboxapp"]
+
+def is_terabox_url(url: str):
+    return any(x in url for x in TERABOX_MARKERS)
+
+def normalize_terabox_url(share_url: str):
+    """
+    Domain Normalization: every Terabox mirror serves the same shares.
+    Replace the share's domain with the preferred mirror (first of TERABOX_MIRRORS).
+    """
+    return mirror_url(share_url, TERABOX_MIRRORS[0])
+
+def parse_cookie(cookie: str):
+    """
+    Parses a user supplied cookie into a {name: value} dict.
+    Accepts "name=value; name2=value2" or a bare 'ndus' token.
+    """
+    cookies = {}
+    if "=" in cookie:
+        for part in cookie.split(';'):
+            if '=' in part:
+                key, value = part.split('=', 1)
+                cookies[key.strip()] = value.strip()
+    else:
+        # Assume it's the 'ndus' token
+        cookies["ndus"] = cookie.strip()
+    return cookies
+
+# Resource types and hosts the resolver never needs
+BLOCKED_RESOURCE_TYPES = {"image", "media", "font", "stylesheet"}
+BLOCKED_URL_PARTS = [
+    "google-analytics.com", "googletagmanager.com", "doubleclick.net", "googlesyndication.com",
+    "googleadservices.com", "facebook.net", "connect.facebook", "/api/analytics", "/nodeapi/reporterror",
+]
+
+# The page is usable once file data, a download button or an error/password marker is present
+SETTLED_PREDICATE = """() => {
+    if (window.yunData && (window.yunData.FILEINFO || window.yunData.filelist)) return true;
+    if (window.msg && window.msg.list) return true;
+    if (document.querySelector('.share-error, .input-code, .download-btn, .btn-download, a[title="Download"]')) return true;
+    const text = document.body ? document.body.innerText : '';
+    return text.includes('Extract code') || text.includes('The link has expired');
+}"""
+SETTLE_TIMEOUT = 10  # Seconds; upper bound, most pages settle far sooner
+
+async def _block_unneeded(route):
+    request = route.request
+    if request.resource_type in BLOCKED_RESOURCE_TYPES or any(p in request.url for p in BLOCKED_URL_PARTS):
+        await route.abort()
+    else:
+        await route.continue_()
+
+async def _capture_file_list(response, captured):
+    if captured.done() or ("/share/list" not in response.url and "/api/shorturlinfo" not in response.url):
+        return
+    # Imported here: terabox_http imports this module for the shared helpers
+    from terabox_http import parse_share_list, is_folder
+    try:
+        files, errno = parse_share_list(await response.json())
+    except Exception:
+        return
+    if any(is_folder(info) or info.get("dlink") for info in files) and not captured.done():
+        captured.set_result(files)
+
+async def _wait_until_settled(page, captured):
+    """Replaces a fixed sleep: returns as soon as a file list is captured or the page settles."""
+    settled = asyncio.ensure_future(page.wait_for_function(SETTLED_PREDICATE, timeout=SETTLE_TIMEOUT * 1000))
+    await asyncio.wait([captured, settled], timeout=SETTLE_TIMEOUT, return_when=asyncio.FIRST_COMPLETED)
+    if not settled.done():
+        settled.cancel()
+    # Timeouts/navigation errors just mean we inspect whatever rendered
+    settled.add_done_callback(lambda f: f.cancelled() or f.exception())
+
+async def _expand_in_browser(context, page, files):
+    """Lists the share's folders through the page's own API, with the context's cookies."""
+    from terabox_http import expand_share, extract_surl
+    js_token = await page.evaluate("() => window.jsToken || null")
+    surl = extract_surl(page.url)
+    origin = page.url.split("/", 3)
+    api_url = f"{origin[0]}//{origin[2]}/share/list"
+
+    async def fetch_json(params):
+        resp = await context.request.get(api_url, params=params, headers={"Referer": page.url})
+        if resp.status != 200:
+            raise RuntimeError(f"share/list returned {resp.status}")
+        return await resp.json()
+
+    return await expand_share(files, fetch_json, js_token, surl)
+
+async def _build_result(context, files, user_agent, referer):
+    from terabox_http import build_result
+    cookies = await context.cookies()
+    cookie_str = "; ".join([f"{c['name']}={c['value']}" for c in cookies])
+    return build_result(files, user_agent, cookie_str, referer)
+
 async def extract_terabox_url(share_url: str, cookie: str = None):
     """
     Extracts the direct download URL from a Terabox share link.
     """
-    async with async_playwright() as p:
-        # Retry logic optimized
-        max_retries = 2
-        
-        # Domain Normalization: 1024tera.com is often less blocked than terabox.com
-        # Replace common domains with 1024tera.com
-        normalized_url = share_url.replace("terabox.com", "1024tera.com") \
-                                  .replace("teraboxapp.com", "1024tera.com") \
-                                  .replace("terasharefile.com", "1024tera.com") \
-                                  .replace("miracledown.com", "1024tera.com")
-        
-        for attempt in range(max_retries):
-            print(f"Attempt {attempt + 1}/{max_retries} for {normalized_url}")
-            browser = None
-            try:
-                # 1. Launch browser with stealth args
-                browser = await p.chromium.launch(
-                    headless=True,
-                    args=[
-                        "--disable-blink-features=AutomationControlled",
-                        "--no-sandbox",
-                        "--disable-setuid-sandbox",
-                        "--disable-dev-shm-usage",
-                        "--disable-accelerated-2d-canvas",
-                        "--no-first-run",
-                        "--no-zygote",
-                        "--disable-gpu",
-                    ]
-                )
-                
-                # 2. Randomize User-Agent and Viewport
-                user_agent = random.choice(UA_LIST)
-                context = await browser.new_context(
-                    user_agent=user_agent,
-                    viewport={"width": 1920, "height": 1080},
-                    locale="en-US",
-                    timezone_id="America/New_York"
-                )
+    # One attempt per mirror, healthiest first (see mirrors.py)
+    max_retries = 2
+    mirrors = MIRRORS.ranked()
+
+    for attempt in range(max_retries):
+        domain = mirrors[attempt % len(mirrors)]
+        normalized_url = mirror_url(share_url, domain)
+        print(f"Attempt {attempt + 1}/{max_retries} for {normalized_url}")
+        try:
+            # 1. Randomize User-Agent and Viewport
+            user_agent = random.choice(UA_LIST)
+
+            # 2. Check out a warm browser from the pool (launched once, with stealth args)
+            async with BROWSER_POOL.context(
+                user_agent=user_agent,
+                viewport={"width": 1920, "height": 1080},
+                locale="en-US",
+                timezone_id="America/New_York"
+            ) as context:
 
                 # Inject User Cookies if provided
                 if cookie:
                     try:
-                        # Simple parsing: check if name=value or just value (assume ndus)
-                        cookie_list = []
-                        if "=" in cookie:
-                             # Handle "name=value; name2=value2"
-                             parts = cookie.split(';')
-                             for part in parts:
-                                 if '=' in part:
-                                     key, value = part.split('=', 1)
-                                     cookie_list.append({"name": key.strip(), "value": value.strip()})
-                        else:
-                             # Assume it's the 'ndus' token
-                             cookie_list.append({"name": "ndus", "value": cookie.strip()})
+                        cookie_list = [{"name": k, "value": v} for k, v in parse_cookie(cookie).items()]
 
                         final_cookies = []
                         for c in cookie_list:
-                            # Add for both domains to be safe
-                            final_cookies.append({**c, "domain": ".terabox.com", "path": "/"})
-                            final_cookies.append({**c, "domain": ".1024tera.com", "path": "/"})
+                            # Add for every mirror to be safe
+                            for cookie_domain in {"terabox.com", *TERABOX_MIRRORS}:
+                                final_cookies.append({**c, "domain": f".{cookie_domain}", "path": "/"})
                         
                         await context.add_cookies(final_cookies)
                         print(f"Injected {len(cookie_list)} user cookies.")
@@ -98,16 +165,38 @@ async def extract_terabox_url(share_url: str, cookie: str = None):
                     );
                 """)
 
+                # 4. Skip images, fonts, styles, ads and analytics; only the document, scripts and XHR matter
+                await context.route("**/*", _block_unneeded)
+
                 page = await context.new_page()
 
-                # 4. Navigate with extra wait
+                # Capture the page's own share/list XHR: it carries the file list with dlinks
+                captured = asyncio.get_running_loop().create_future()
+                page.on("response", lambda response: _capture_file_list(response, captured))
+
+                # 5. Navigate, then wait until a dlink is seen or the page has rendered something we can use
+                # The timeout adapts to the mirror's recent latency instead of always waiting 45s
                 print(f"Navigating to {normalized_url}...")
-                await page.goto(normalized_url, wait_until="domcontentloaded", timeout=45000)
-                
-                # Wait for potential redirects or JS execution
-                await page.wait_for_timeout(3000) # Give it a moment to settle
+                MIRRORS.begin(domain)
+                started = time.monotonic()
+                try:
+                    await page.goto(normalized_url, wait_until="domcontentloaded",
+                                    timeout=MIRRORS.navigation_timeout(domain) * 1000)
+                except Exception:
+                    MIRRORS.failure(domain)
+                    PAGE_NAVIGATION_SECONDS.observe(time.monotonic() - started, domain, "error")
+                    raise
+                MIRRORS.success(domain, time.monotonic() - started)
+                PAGE_NAVIGATION_SECONDS.observe(time.monotonic() - started, domain, "ok")
+                await _wait_until_settled(page, captured)
+
+                if captured.done():
+                    files = await _expand_in_browser(context, page, captured.result())
+                    if files:
+                        print(f"Found {len(files)} file(s) via network capture")
+                        return await _build_result(context, files, user_agent, normalized_url)
 
-                # 5. Check for password protection or validity
+                # 6. Check for password protection or validity
                 content = await page.content()
                 if "Extract code" in content or "input-code" in content:
                      return {"error": "Password-protected links are not supported yet."}
@@ -122,14 +211,33 @@ async def extract_terabox_url(share_url: str, cookie: str = None):
                 if "passport.terabox.com" in page.url or "login" in page.url.lower():
                     return {"error": "LOGIN_REQUIRED", "details": "This file can only be accessed by a logged-in user."}
 
-                # 6. Extract File Info
-                # Strategy: Check DOM first (Download Button), then JS variables as fallback.
-                
+                # 7. Extract File Info
+                # Strategy: Check the page's JS file list first (covers multi-file and folder shares),
+                # then the DOM Download Button for single-file pages.
+                file_list = await page.evaluate("""() => {
+                    try {
+                        if (window.yunData && window.yunData.FILEINFO) return window.yunData.FILEINFO;
+                        if (window.yunData && window.yunData.filelist) return window.yunData.filelist;
+                        if (window.msg && window.msg.list) return window.msg.list;
+                    } catch (e) { return null; }
+                    return null;
+                }""")
+
+                if file_list:
+                    files = await _expand_in_browser(context, page, file_list)
+                    if files:
+                        print(f"Found {len(files)} file(s) via JS, first {files[0].get('server_filename')}")
+                        return await _build_result(context, files, user_agent, normalized_url)
+
                 final_url = None
                 filename = "downloaded_file"
                 size = 0
+                if file_list:
+                    # Keep the name/size of a file the page lists without a dlink
+                    filename = file_list[0].get('server_filename', filename)
+                    size = file_list[0].get('size', 0)
 
-                # Check DOM for Download Button
+                # Fallback: DOM Download Button
                 print("Checking DOM for download button...")
                 download_btn = await page.query_selector('.download-btn, .btn-download, a[title="Download"], a:has-text("Download")')
                 if download_btn:
@@ -148,57 +256,16 @@ async def extract_terabox_url(share_url: str, cookie: str = None):
                                      filename = clean_name
                          except: pass
 
-                # Fallback: JS Variables
-                if not final_url:
-                    file_info = await page.evaluate("""() => {
-                        try {
-                            if (window.yunData && window.yunData.FILEINFO) return window.yunData.FILEINFO[0];
-                            if (window.yunData && window.yunData.filelist) return window.yunData.filelist[0];
-                            if (window.msg && window.msg.list) return window.msg.list[0];
-                        } catch (e) { return null; }
-                        return null;
-                    }""")
-
-                    if file_info:
-                        print(f"Found file info via JS: {file_info.get('server_filename')}")
-                        filename = file_info.get('server_filename', filename)
-                        size = file_info.get('size', 0)
-                        if 'dlink' in file_info:
-                            final_url = file_info['dlink']
-                     if download_btn:
-                         href = await download_btn.get_attribute('href')
-                         if href and href.startswith('http'):
-                             final_url = href
-
                 if final_url:
-                    # Validate URL format
-                    if "d.terabox.com" in final_url or "d.1024tera.com" in final_url:
-                        pass
-
-                    cookies = await context.cookies()
-                    cookie_str = "; ".join([f"{c['name']}={c['value']}" for c in cookies])
-
-                    return {
-                        "success": True,
-                        "url": final_url,
-                        "filename": filename,
-                        "size": size,
-                        "headers": {
-                            "User-Agent": user_agent,
-                            "Cookie": cookie_str,
-                            "Referer": normalized_url
-                        }
-                    }
+                    info = {"dlink": final_url, "server_filename": filename, "size": size}
+                    return await _build_result(context, [info], user_agent, normalized_url)
                 else:
                     print("Could not find URL on this attempt.")
                     
-            except Exception as e:
-                print(f"Error on attempt {attempt + 1}: {e}")
-                # Wait longer before retrying
+        except Exception as e:
+            print(f"Error on attempt {attempt + 1}: {e}")
+            # The next attempt goes to another mirror right away; only back off before reusing this one
+            if len(mirrors) == 1:
                 await asyncio.sleep(2 * (attempt + 1))
-            
-            finally:
-                if browser:
-                    await browser.close()
-        
-        return {"error": "Unable to extract file. The link is likely Dead, Blocked, or requires Login/CAPTCHA."}
+
+    return {"error": "Unable to extract file. The link is likely Dead, Blocked, or requires Login/CAPTCHA."}
@@ -0,0 +1,266 @@
+import asyncio
+import aiohttp
+import os
+import re
+import time
+from metrics import UPSTREAM_ERRORS
+
+# Segmented proxy tuning (overridable from the environment)
+SEGMENT_MAX_CONNECTIONS = int(os.environ.get("SEGMENT_MAX_CONNECTIONS", "4"))  # 1 disables segmented mode
+SEGMENT_SIZE = int(os.environ.get("SEGMENT_SIZE", str(4 * 1024 * 1024)))
+SEGMENT_BUFFER = int(os.environ.get("SEGMENT_BUFFER", "8"))  # Max segments held in memory per download
+SEGMENT_MIN_FILE_SIZE = int(os.environ.get("SEGMENT_MIN_FILE_SIZE", str(16 * 1024 * 1024)))
+SEGMENT_RETRIES = 3
+
+# Throughput is re-evaluated every ADAPT_INTERVAL seconds; a connection is added
+# while the aggregate rate keeps improving by more than ADAPT_GAIN, removed when it drops.
+ADAPT_INTERVAL = 2.0
+ADAPT_GAIN = 0.10
+
+CONTENT_RANGE_RE = re.compile(r"bytes (\d+)-(\d+)/(\d+|\*)")
+
+
+def parse_content_range(value):
+    """'bytes 0-99/1000' -> (0, 99, 1000); total is None when unknown."""
+    match = CONTENT_RANGE_RE.match(value or "")
+    if not match:
+        return None
+    start, end, total = match.groups()
+    return int(start), int(end), (None if total == "*" else int(total))
+
+
+def segment_span(resp):
+    """
+    Returns the (start, end) byte span an upstream response covers when it can be
+    fetched in segments, or None when it must be streamed as a single connection.
+    """
+    if SEGMENT_MAX_CONNECTIONS < 2:
+        return None
+    if resp.status == 206:
+        parsed = parse_content_range(resp.headers.get("Content-Range"))
+        if not parsed:
+            return None
+        start, end = parsed[0], parsed[1]
+    elif resp.status == 200 and resp.headers.get("Accept-Ranges", "").lower() == "bytes":
+        length = resp.headers.get("Content-Length")
+        if not length or not length.isdigit():
+            return None
+        start, end = 0, int(length) - 1
+    else:
+        return None
+    if resp.headers.get("Content-Encoding"):
+        return None
+    if end - start + 1 < SEGMENT_MIN_FILE_SIZE:
+        return None
+    return start, end
+
+
+class SegmentedDownload:
+    """
+    Fetches byte ranges of one upstream file over several connections and yields
+    them in order. Segments wait in a bounded reorder buffer, so memory stays at
+    SEGMENT_BUFFER * SEGMENT_SIZE per download whatever the file size.
+
+    The already-open first response serves the first segment (no extra TTFB); if
+    the origin answers a range request with anything but 206, the download falls
+    back to reading that first response as a single stream. If the first response
+    drops, segment 0 is fetched again as a range.
+
+    `reopen(headers)`, when given, opens each segment request instead of a plain GET
+    on `url`, so a link that expires or is rejected mid-download can be refreshed.
+    """
+
+    def __init__(self, session, url, headers, first_resp, start, end,
+                 max_connections=SEGMENT_MAX_CONNECTIONS, segment_size=SEGMENT_SIZE,
+                 buffer_segments=SEGMENT_BUFFER, reopen=None):
+        self.session = session
+        self.url = url
+        self.reopen = reopen
+        self.headers = {k: v for k, v in headers.items() if k not in ("Range", "If-Range")}
+        # Pin segments to the same representation as the first response
+        validator = first_resp.headers.get("ETag") or first_resp.headers.get("Last-Modified")
+        if validator:
+            self.headers["If-Range"] = validator
+        self.first_resp = first_resp
+        self.segments = [(s, min(s + segment_size, end + 1) - 1) for s in range(start, end + 1, segment_size)]
+        self.max_connections = max(1, max_connections)
+        self.buffer_segments = max(2, buffer_segments)
+
+        self.buffer = {}
+        self.next_index = 1  # Segment 0 comes from the first response
+        self.next_yield = 0
+        self.cond = asyncio.Condition()
+        self.error = None
+        self.ranges_confirmed = False
+        self.fallback = False
+
+        self.target = min(2, self.max_connections)
+        self.active = 0
+        self.tasks = set()
+        self._window_bytes = 0
+        self._window_start = time.monotonic()
+        self._last_rate = 0.0
+
+    # Adaptive connection count
+
+    def _record(self, nbytes):
+        self._window_bytes += nbytes
+        elapsed = time.monotonic() - self._window_start
+        if elapsed < ADAPT_INTERVAL:
+            return
+        rate = self._window_bytes / elapsed
+        if rate > self._last_rate * (1 + ADAPT_GAIN) and self.target < self.max_connections:
+            self.target += 1
+        elif rate < self._last_rate * (1 - ADAPT_GAIN) and self.target > 1:
+            self.target -= 1
+        self._last_rate = rate
+        self._window_bytes = 0
+        self._window_start = time.monotonic()
+        self._spawn()
+
+    def _spawn(self):
+        while self.active < self.target and self.next_index < len(self.segments) and not self.fallback:
+            self.active += 1
+            task = asyncio.create_task(self._worker())
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    # Workers
+
+    def _can_take(self):
+        return (self.error is not None or self.fallback
+                or self.next_index >= len(self.segments)
+                or self.active > self.target
+                or self.next_index < self.next_yield + self.buffer_segments)
+
+    async def _worker(self):
+        try:
+            while True:
+                async with self.cond:
+                    await self.cond.wait_for(self._can_take)
+                    if (self.error is not None or self.fallback
+                            or self.next_index >= len(self.segments) or self.active > self.target):
+                        return
+                    index = self.next_index
+                    self.next_index += 1
+
+                data = await self._fetch(index)
+                if data is None:
+                    return
+
+                async with self.cond:
+                    self.buffer[index] = data
+                    self._record(len(data))
+                    self.cond.notify_all()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            async with self.cond:
+                self.error = self.error or e
+                self.cond.notify_all()
+        finally:
+            self.active -= 1
+
+    async def _open(self, headers):
+        if self.reopen:
+            return await self.reopen(headers)
+        return await self.session.get(self.url, headers=headers)
+
+    async def _fetch(self, index):
+        start, end = self.segments[index]
+        headers = {**self.headers, "Range": f"bytes={start}-{end}"}
+        last_error = None
+        for attempt in range(SEGMENT_RETRIES):
+            try:
+                resp = await self._open(headers)
+                try:
+                    if resp.status != 206:
+                        if not self.ranges_confirmed:
+                            # Origin ignores ranges: continue on the first response instead
+                            print(f"Segmented proxy: range request returned {resp.status}, using single stream")
+                            async with self.cond:
+                                self.fallback = True
+                                self.cond.notify_all()
+                            return None
+                        if resp.status < 400 or not self.reopen:
+                            # Error statuses of reopened requests are counted by the opener
+                            UPSTREAM_ERRORS.inc(str(resp.status))
+                        raise RuntimeError(f"Segment request returned {resp.status}")
+                    data = await resp.read()
+                finally:
+                    resp.release()
+                if len(data) != end - start + 1:
+                    UPSTREAM_ERRORS.inc("short_body")
+                    raise RuntimeError(f"Short segment ({len(data)} of {end - start + 1} bytes)")
+                if not self.ranges_confirmed:
+                    async with self.cond:
+                        self.ranges_confirmed = True
+                        if self.next_yield > 0:
+                            # Segment 0 already went out; the first connection is no longer needed
+                            self.first_resp.release()
+                        self.cond.notify_all()
+                return data
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                last_error = e
+                if not isinstance(e, RuntimeError):
+                    # Raised above, already counted
+                    UPSTREAM_ERRORS.inc(type(e).__name__)
+                await asyncio.sleep(0.5 * (attempt + 1))
+        raise last_error
+
+    async def _read_first_segment(self):
+        start, end = self.segments[0]
+        try:
+            try:
+                data = await self.first_resp.content.readexactly(end - start + 1)
+            except (aiohttp.ClientError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+                print(f"Segmented proxy: first response failed ({e!r}), fetching segment 0 again")
+                UPSTREAM_ERRORS.inc(type(e).__name__)
+                data = await self._fetch(0)
+                if data is None:
+                    raise RuntimeError("First response failed and the origin ignores ranges") from e
+            async with self.cond:
+                self.buffer[0] = data
+                self._record(len(data))
+                self.cond.notify_all()
+        except Exception as e:
+            async with self.cond:
+                self.error = self.error or e
+                self.cond.notify_all()
+
+    # Consumer
+
+    async def stream(self):
+        first = asyncio.create_task(self._read_first_segment())
+        self.tasks.add(first)
+        first.add_done_callback(self.tasks.discard)
+        self._spawn()
+        try:
+            while self.next_yield < len(self.segments):
+                async with self.cond:
+                    await self.cond.wait_for(
+                        lambda: self.next_yield in self.buffer or self.error is not None
+                        or (self.fallback and self.next_yield > 0)
+                    )
+                    if self.next_yield in self.buffer:
+                        data = self.buffer.pop(self.next_yield)
+                        self.next_yield += 1
+                        if self.next_yield == 1 and self.ranges_confirmed:
+                            self.first_resp.release()
+                        self.cond.notify_all()
+                    elif self.error is not None:
+                        raise self.error
+                    else:
+                        break
+                yield data
+
+            if self.fallback and self.next_yield < len(self.segments):
+                # Single stream: the first response continues right after segment 0
+                async for chunk in self.first_resp.content.iter_chunked(1024 * 1024):
+                    yield chunk
+        finally:
+            for task in list(self.tasks):
+                task.cancel()
+            self.first_resp.release()
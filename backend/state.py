@@ -0,0 +1,233 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+# State backend selection (overridable from the environment)
+STATE_BACKEND = os.environ.get("STATE_BACKEND", "local")  # local | sqlite
+STATE_DB_PATH = os.environ.get("STATE_DB_PATH", "state.db")
+COOKIE_FILE = os.environ.get("COOKIE_FILE", "cookies.json")
+STATE_PURGE_INTERVAL = 300  # Seconds between removals of expired rows
+
+
+def _atomic_write_json(path, data):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class LocalState:
+    """
+    Single-worker state: resolved links and jobs live only in the worker's own caches,
+    small key/value settings (the stored cookie) in a JSON file.
+    """
+    shared = False
+
+    def __init__(self, path: str = COOKIE_FILE):
+        self.path = path
+        self._values = None
+        self._lock = threading.Lock()
+
+    def put_files(self, rows):
+        pass
+
+    def get_file(self, file_id):
+        return None
+
+    def put_jobs(self, rows):
+        pass
+
+    def get_job(self, job_id):
+        return None
+
+    def claim(self, key, owner, expires_at):
+        # Only one worker: JobQueue already deduplicates in memory
+        return owner
+
+    def release(self, key, owner):
+        pass
+
+    def _load(self):
+        if self._values is None:
+            try:
+                with open(self.path) as f:
+                    self._values = json.load(f)
+            except (OSError, ValueError):
+                self._values = {}
+        return self._values
+
+    def get_value(self, key):
+        with self._lock:
+            return self._load().get(key)
+
+    def get_values(self, prefix):
+        """Every value whose key starts with `prefix`, by key."""
+        with self._lock:
+            return {k: v for k, v in self._load().items() if k.startswith(prefix) and v is not None}
+
+    def set_value(self, key, value):
+        with self._lock:
+            self._write({**self._load(), key: value})
+
+    def update_value(self, key, value):
+        """Sets `key` only when it exists (a concurrent delete wins)."""
+        with self._lock:
+            if self._load().get(key) is not None:
+                self._write({**self._load(), key: value})
+
+    def delete_value(self, key):
+        with self._lock:
+            if key in self._load():
+                self._write({k: v for k, v in self._load().items() if k != key})
+
+    def _write(self, values):
+        _atomic_write_json(self.path, values)
+        self._values = values
+
+    def stats(self):
+        return {"backend": "local", "shared": False}
+
+
+class SqliteState:
+    """
+    State shared by every worker on one host, in an SQLite database in WAL mode:
+    readers never block the writer, so `uvicorn --workers N` can hand out a fileId
+    or jobId on one worker and serve it from another. Every method blocks (writers
+    wait up to 5 s for the lock), so code on the event loop calls them in a thread.
+    """
+    shared = True
+
+    def __init__(self, path: str = STATE_DB_PATH):
+        self.path = path
+        self._conn = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._last_purge = 0.0
+
+    def _db(self):
+        # One connection per process (workers may be forked after import)
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS files (id TEXT PRIMARY KEY, data TEXT NOT NULL, expires_at REAL NOT NULL);
+                CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, data TEXT NOT NULL, expires_at REAL NOT NULL);
+                CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+                CREATE TABLE IF NOT EXISTS claims (key TEXT PRIMARY KEY, owner TEXT NOT NULL, pid INTEGER NOT NULL,
+                                                   expires_at REAL NOT NULL);
+            """)
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    def _execute(self, sql, params=(), many=False):
+        with self._lock:
+            db = self._db()
+            now = time.time()
+            if now - self._last_purge > STATE_PURGE_INTERVAL:
+                self._last_purge = now
+                db.execute("DELETE FROM files WHERE expires_at <= ?", (now,))
+                db.execute("DELETE FROM jobs WHERE expires_at <= ?", (now,))
+                db.execute("DELETE FROM claims WHERE expires_at <= ?", (now,))
+            cursor = db.execute(sql, params)
+            return cursor.fetchall() if many else cursor.fetchone()
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            db = self._db()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                yield db
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+
+    def _put_many(self, table, rows):
+        """Writes (key, data, expires_at) rows in one transaction."""
+        with self._transaction() as db:
+            db.executemany(f"INSERT OR REPLACE INTO {table} (id, data, expires_at) VALUES (?, ?, ?)",
+                           [(key, json.dumps(data), expires_at) for key, data, expires_at in rows])
+
+    def _get(self, table, key):
+        row = self._execute(f"SELECT data FROM {table} WHERE id = ? AND expires_at > ?", (key, time.time()))
+        return json.loads(row[0]) if row else None
+
+    def put_files(self, rows):
+        self._put_many("files", rows)
+
+    def get_file(self, file_id):
+        return self._get("files", file_id)
+
+    def put_jobs(self, rows):
+        self._put_many("jobs", rows)
+
+    def get_job(self, job_id):
+        return self._get("jobs", job_id)
+
+    def claim(self, key, owner, expires_at):
+        """
+        Claims `key` for `owner` (a job id) across workers. Returns the owner holding the
+        claim afterwards: `owner` when it was free, expired or left by a dead process.
+        """
+        with self._transaction() as db:
+            row = db.execute("SELECT owner, pid, expires_at FROM claims WHERE key = ?", (key,)).fetchone()
+            if row and row[2] > time.time() and _process_alive(row[1]):
+                return row[0]
+            db.execute("INSERT OR REPLACE INTO claims (key, owner, pid, expires_at) VALUES (?, ?, ?, ?)",
+                       (key, owner, os.getpid(), expires_at))
+            return owner
+
+    def release(self, key, owner):
+        self._execute("DELETE FROM claims WHERE key = ? AND owner = ?", (key, owner))
+
+    def get_value(self, key):
+        row = self._execute("SELECT value FROM kv WHERE key = ?", (key,))
+        return json.loads(row[0]) if row else None
+
+    def get_values(self, prefix):
+        rows = self._execute("SELECT key, value FROM kv WHERE substr(key, 1, ?) = ?", (len(prefix), prefix), many=True)
+        values = {key: json.loads(value) for key, value in rows}
+        return {key: value for key, value in values.items() if value is not None}
+
+    def set_value(self, key, value):
+        self._execute("INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+
+    def update_value(self, key, value):
+        self._execute("UPDATE kv SET value = ? WHERE key = ?", (json.dumps(value), key))
+
+    def delete_value(self, key):
+        self._execute("DELETE FROM kv WHERE key = ?", (key,))
+
+    def stats(self):
+        with self._lock:
+            db = self._db()
+            files = db.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+            jobs = db.execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+        return {"backend": "sqlite", "shared": True, "path": self.path, "files": files, "jobs": jobs}
+
+
+def create_state(backend: str = STATE_BACKEND):
+    if backend == "sqlite":
+        return SqliteState()
+    if backend != "local":
+        raise ValueError(f"Unknown STATE_BACKEND: {backend}")
+    return LocalState()
+
+
+# Shared state backend; STATE_BACKEND=sqlite when running several workers
+STATE = create_state()
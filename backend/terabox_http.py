@@ -0,0 +1,313 @@
+import asyncio
+import json
+import os
+import random
+import re
+import aiohttp
+from urllib.parse import urlparse, parse_qs
+from scraper import UA_LIST, parse_cookie
+from mirrors import MIRRORS, MirrorError, mirror_url
+from http_client import HTTP_CLIENT
+
+# Public web app id used by the Terabox share page when calling its own API
+TERABOX_APP_ID = "250528"
+HTTP_TIMEOUT = aiohttp.ClientTimeout(total=15, connect=5)
+
+# Multi-file share tuning (overridable from the environment)
+SHARE_LIST_CONCURRENCY = int(os.environ.get("TERABOX_LIST_CONCURRENCY", "4"))  # Folder listings in flight per share
+SHARE_MAX_FILES = int(os.environ.get("TERABOX_MAX_FILES", "500"))
+SHARE_LIST_PAGE_SIZE = 100
+
+# Share page statuses that count against the mirror's health (besides 5xx)
+MIRROR_FAILURE_STATUSES = {403, 429}
+
+# Markers of anti-bot / verification pages that need a real browser
+CHALLENGE_MARKERS = ["captcha", "verify-code", "security verification", "cf-challenge"]
+
+JS_TOKEN_RE = re.compile(r'fn%28%22([0-9A-Fa-f]+)%22%29|fn\("([0-9A-Fa-f]+)"\)')
+
+
+def _decode_js_object(html, marker):
+    """Decodes the JSON object literal assigned/passed right after `marker` in the page."""
+    start = html.find(marker)
+    if start == -1:
+        return None
+    brace = html.find("{", start + len(marker))
+    if brace == -1:
+        return None
+    try:
+        value, _ = json.JSONDecoder().raw_decode(html, brace)
+        return value
+    except ValueError:
+        return None
+
+
+def _first_file_list(data):
+    if not isinstance(data, dict):
+        return []
+    for key in ("FILEINFO", "filelist", "file_list", "list"):
+        value = data.get(key)
+        if isinstance(value, dict):
+            value = value.get("list")
+        if isinstance(value, list) and value:
+            return value
+    return []
+
+
+def extract_surl(share_url: str):
+    """
+    Returns the short url id used by the share/list API.
+    /s/1AbC -> AbC, ?surl=AbC -> AbC
+    """
+    parsed = urlparse(share_url)
+    query = parse_qs(parsed.query)
+    if query.get("surl"):
+        return query["surl"][0]
+    match = re.search(r"/s/([A-Za-z0-9_-]+)", parsed.path)
+    if match:
+        surl = match.group(1)
+        return surl[1:] if surl.startswith("1") else surl
+    return None
+
+
+def parse_share_page(html: str):
+    """
+    Parses a Terabox share page without executing it.
+    Returns a dict with js_token, bdstoken, files (list of file info dicts),
+    and error/challenge flags.
+    """
+    result = {"js_token": None, "bdstoken": None, "files": [], "error": None, "challenge": False}
+
+    # Same checks the browser path does on the rendered page
+    if "Extract code" in html or "input-code" in html:
+        result["error"] = "Password-protected links are not supported yet."
+        return result
+    if "The link has expired" in html:
+        result["error"] = "This Terabox link has expired or is invalid."
+        return result
+    if "we can’t find the page" in html or "share-error-msg" in html:
+        result["error"] = "Link was not found (404). It may be deleted or region-blocked."
+        return result
+
+    lowered = html.lower()
+    if any(marker in lowered for marker in CHALLENGE_MARKERS):
+        result["challenge"] = True
+
+    match = JS_TOKEN_RE.search(html)
+    if match:
+        result["js_token"] = match.group(1) or match.group(2)
+
+    template = _decode_js_object(html, "var templateData")
+    if isinstance(template, dict):
+        result["bdstoken"] = template.get("bdstoken") or None
+
+    for marker in ("window.yunData", "var yunData", "locals.mset("):
+        files = _first_file_list(_decode_js_object(html, marker))
+        if files:
+            result["files"] = files
+            break
+
+    return result
+
+
+def parse_share_list(payload):
+    """
+    Parses a share/list API response.
+    Returns (files, errno). errno is 0 on success.
+    """
+    if not isinstance(payload, dict):
+        return [], -1
+    errno = payload.get("errno", -1)
+    if errno != 0:
+        return [], errno
+    return _first_file_list(payload), 0
+
+
+def is_folder(info):
+    return str(info.get("isdir", 0)) == "1"
+
+
+def share_list_params(js_token, surl, directory=None, page=1):
+    """Query of a share/list call: the share root, or `directory` (a path inside the share)."""
+    params = {
+        "app_id": TERABOX_APP_ID,
+        "web": "1",
+        "channel": "dubox",
+        "clienttype": "0",
+        "jsToken": js_token,
+        "page": str(page),
+        "num": str(SHARE_LIST_PAGE_SIZE),
+        "by": "name",
+        "order": "asc",
+        "shorturl": surl,
+    }
+    if directory:
+        params.update({"dir": directory, "root": "0"})
+    else:
+        params["root"] = "1"
+    return params
+
+
+async def list_share_dir(fetch_json, js_token, surl, directory=None):
+    """
+    Lists every entry of one share directory, following pages.
+    `fetch_json(params)` performs the share/list request and returns the decoded payload.
+    """
+    entries = []
+    page = 1
+    while True:
+        files, errno = parse_share_list(await fetch_json(share_list_params(js_token, surl, directory, page)))
+        if errno != 0:
+            raise RuntimeError(f"share/list errno {errno}")
+        entries.extend(files)
+        if len(files) < SHARE_LIST_PAGE_SIZE or len(entries) >= SHARE_MAX_FILES:
+            return entries
+        page += 1
+
+
+async def expand_share(files, fetch_json, js_token, surl):
+    """
+    Flattens a share listing into its downloadable files (those carrying a dlink),
+    in listing order. Folders are listed recursively, several at a time; without
+    a jsToken/surl to list them with, they are skipped.
+    """
+    slots = asyncio.Semaphore(max(1, SHARE_LIST_CONCURRENCY))
+    found = [0]  # Files collected so far, to stop descending past SHARE_MAX_FILES
+
+    async def list_folder(path):
+        try:
+            async with slots:
+                entries = await list_share_dir(fetch_json, js_token, surl, path)
+        except Exception as e:
+            print(f"Could not list share folder {path}: {e}")
+            return []
+        return await walk(entries)
+
+    async def walk(entries):
+        parts = []
+        for info in entries:
+            if is_folder(info):
+                if js_token and surl and info.get("path") and found[0] < SHARE_MAX_FILES:
+                    parts.append(asyncio.ensure_future(list_folder(info["path"])))
+            elif info.get("dlink"):
+                found[0] += 1
+                parts.append([info])
+        flat = []
+        for part in parts:
+            flat.extend(await part if asyncio.isfuture(part) else part)
+        return flat
+
+    return (await walk(files))[:SHARE_MAX_FILES]
+
+
+def build_result(files, user_agent, cookie_str, referer):
+    """Resolve result for a share; the first file is the top-level entry, `files` lists them all."""
+    first = files[0]
+    return {
+        "success": True,
+        "url": first["dlink"],
+        "filename": first.get("server_filename", "downloaded_file"),
+        "size": int(first.get("size") or 0),
+        "files": [
+            {
+                "url": info["dlink"],
+                "filename": info.get("server_filename", "downloaded_file"),
+                "size": int(info.get("size") or 0),
+                "path": info.get("path"),
+            }
+            for info in files
+        ],
+        "headers": {
+            "User-Agent": user_agent,
+            "Cookie": cookie_str,
+            "Referer": referer
+        }
+    }
+
+
+async def resolve_terabox_http(share_url: str, cookie: str = None):
+    """
+    Resolves a Terabox share link with plain HTTP requests (no browser).
+    Returns a resolve result, an {"error": ...} dict for definitive failures,
+    or None when the Playwright path should take over (challenge, missing data).
+    """
+    user_agent = random.choice(UA_LIST)
+    headers = {
+        "User-Agent": user_agent,
+        "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+        "Accept-Language": "en-US,en;q=0.9",
+    }
+    cookies = parse_cookie(cookie) if cookie else {}
+
+    try:
+        # Own cookie jar per resolve (share pages set cookies the API call needs),
+        # but pooled connections from the shared connector
+        connector = await HTTP_CLIENT.connector()
+        async with aiohttp.ClientSession(connector=connector, connector_owner=False,
+                                         timeout=HTTP_TIMEOUT, cookies=cookies) as session:
+            async def fetch_page(url):
+                print(f"HTTP fast path: fetching {url}")
+                async with session.get(url, headers=headers) as resp:
+                    if resp.status in MIRROR_FAILURE_STATUSES or resp.status >= 500:
+                        raise MirrorError(f"share page returned {resp.status}")
+                    # Anything else is about the share, not the mirror
+                    return str(resp.url), (await resp.text() if resp.status == 200 else None)
+
+            # Healthiest mirror first, hedged with another one when it is slow
+            try:
+                (final_url, html), domain = await MIRRORS.race(share_url, fetch_page)
+            except MirrorError as e:
+                print(f"HTTP fast path: {e}, falling back to browser")
+                return None
+            normalized_url = mirror_url(share_url, domain)
+            if html is None:
+                print("HTTP fast path: share page unavailable, falling back to browser")
+                return None
+
+            # Detect Login Page Redirect
+            if "passport.terabox.com" in final_url or "login" in final_url.lower():
+                return {"error": "LOGIN_REQUIRED", "details": "This file can only be accessed by a logged-in user."}
+
+            page = parse_share_page(html)
+            if page["error"]:
+                return {"error": page["error"]}
+
+            surl = extract_surl(final_url) or extract_surl(normalized_url)
+            origin = urlparse(final_url)
+            api_url = f"{origin.scheme}://{origin.netloc}/share/list"
+            api_headers = {**headers, "Accept": "application/json, text/plain, */*", "Referer": final_url}
+
+            async def fetch_json(params):
+                async with session.get(api_url, params=params, headers=api_headers) as resp:
+                    if resp.status != 200:
+                        raise RuntimeError(f"share/list returned {resp.status}")
+                    return await resp.json(content_type=None)
+
+            files = page["files"]
+            if not any(is_folder(info) or info.get("dlink") for info in files):
+                if page["challenge"] or not page["js_token"]:
+                    print("HTTP fast path: challenge or missing jsToken, falling back to browser")
+                    return None
+                if not surl:
+                    return None
+                try:
+                    files = await list_share_dir(fetch_json, page["js_token"], surl)
+                except Exception as e:
+                    print(f"HTTP fast path: {e}, falling back to browser")
+                    return None
+
+            # Every file of the share, folders included
+            files = await expand_share(files, fetch_json, page["js_token"], surl)
+            if not files:
+                print("HTTP fast path: no dlink in share, falling back to browser")
+                return None
+
+            cookie_jar = {c.key: c.value for c in session.cookie_jar}
+            cookie_jar.update(cookies)
+            cookie_str = "; ".join(f"{k}={v}" for k, v in cookie_jar.items())
+
+            print(f"HTTP fast path: resolved {len(files)} file(s), first {files[0].get('server_filename')}")
+            return build_result(files, user_agent, cookie_str, normalized_url)
+    except Exception as e:
+        print(f"HTTP fast path error: {e}")
+        return None
@@ -0,0 +1,76 @@
+import asyncio
+import json
+import os
+from fastapi.testclient import TestClient
+import main
+from file_cache import FILE_CACHE
+from file_index import FILE_INDEX
+from janitor import JANITOR
+from proxy_cache import PROXY_CACHE, upstream_key
+
+UNSATISFIABLE = {"Range": "bytes=999999999-"}
+MALFORMED = {"Range": "bytes=9-1"}
+
+
+def test_local_file_lease_released_after_bad_range():
+    output_key = "0123456789abcdef0123456789abcdef"
+    path = os.path.join(FILE_INDEX.directory, f"{output_key}.mp4")
+    with TestClient(main.app) as client:
+        with open(path, "wb") as f:
+            f.write(os.urandom(4096))
+        try:
+            FILE_INDEX.add(path)
+            assert client.get(f"/api/download/{output_key}", headers={"Range": "bytes=0-99"}).status_code == 206
+            assert client.get(f"/api/download/{output_key}", headers=UNSATISFIABLE).status_code == 416
+            assert client.get(f"/api/download/{output_key}", headers=MALFORMED).status_code == 400
+            assert not JANITOR.in_use(f"{output_key}.mp4")
+            assert JANITOR.stats()["streaming"] == 0
+        finally:
+            FILE_INDEX.discard(f"{output_key}.mp4")
+            os.remove(path)
+
+
+def test_cache_entry_released_after_bad_range(tmp_path, monkeypatch):
+    monkeypatch.setattr(PROXY_CACHE, "enabled", True)
+    monkeypatch.setattr(PROXY_CACHE, "directory", str(tmp_path))
+    monkeypatch.setattr(PROXY_CACHE, "entries", {})
+    size = 4096
+    url = "http://cdn.example/file/a?fid=42&sign=abc"
+    key = upstream_key(url, size)
+    (tmp_path / key).write_bytes(os.urandom(size))
+    (tmp_path / f"{key}.json").write_text(json.dumps({"size": size}))
+    asyncio.run(FILE_CACHE.put("cached-file", url, "a.bin", size))
+    with TestClient(main.app) as client:
+        assert client.get("/api/download/cached-file", headers={"Range": "bytes=0-99"}).status_code == 206
+        assert client.get("/api/download/cached-file", headers=UNSATISFIABLE).status_code == 416
+        assert client.get("/api/download/cached-file", headers=MALFORMED).status_code == 400
+    assert PROXY_CACHE.entries[key].readers == 0
+
+
+def test_zip_leases_released_when_body_never_starts():
+    output_key = "fedcba9876543210fedcba9876543210"
+    path = os.path.join(FILE_INDEX.directory, f"{output_key}.mp4")
+    with open(path, "wb") as f:
+        f.write(os.urandom(4096))
+
+    async def gone(message):
+        raise OSError("client disconnected")
+
+    async def receive():
+        return {"type": "http.disconnect"}
+
+    async def run():
+        response = await main.download_zip(ids=output_key)
+        assert JANITOR.in_use(f"{output_key}.mp4")
+        try:
+            await response({"type": "http", "method": "GET", "headers": []}, receive, gone)
+        except OSError:
+            pass
+
+    try:
+        FILE_INDEX.add(path)
+        asyncio.run(run())
+        assert not JANITOR.in_use(f"{output_key}.mp4")
+    finally:
+        FILE_INDEX.discard(f"{output_key}.mp4")
+        os.remove(path)
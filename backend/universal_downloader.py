@@ -1,23 +1,94 @@
-import yt_dlp
 import asyncio
+import hashlib
 import os
-import uuid
-from scraper import extract_terabox_url
+import time
+from scraper import extract_terabox_url, is_terabox_url
+from terabox_http import resolve_terabox_http
+from resolve_cache import RESOLVE_CACHE, cache_key, canonical_url
+from cookie_pool import COOKIE_POOL, COOKIE_POOL_RETRIES
+from ytdlp_pool import YTDLP_POOL, YTDLP_EXTRACT_TIMEOUT, YTDLP_DOWNLOAD_TIMEOUT
+from metrics import RESOLVE_SECONDS, RESOLVES
 
-# Directory for processed downloads
+# Directory for processed downloads (created by the app lifespan, not at import)
 DOWNLOAD_DIR = "downloads"
-if not os.path.exists(DOWNLOAD_DIR):
-    os.makedirs(DOWNLOAD_DIR)
+
+# Container processed outputs are merged into, and extensions a finished output can have
+OUTPUT_CONTAINER = 'mp4'
+OUTPUT_EXTS = ['mp4', 'mkv', 'webm', 'm4a']
+
+# Concurrent resolves per backend (overridable from the environment); the HTTP fast path is not limited
+BROWSER_RESOLVE_CONCURRENCY = int(os.environ.get("BROWSER_RESOLVE_CONCURRENCY", os.environ.get("BROWSER_POOL_SIZE", "2")))
+YTDLP_RESOLVE_CONCURRENCY = int(os.environ.get("YTDLP_RESOLVE_CONCURRENCY", "4"))
+
+_browser_slots = asyncio.Semaphore(max(1, BROWSER_RESOLVE_CONCURRENCY))
+_ytdlp_slots = asyncio.Semaphore(max(1, YTDLP_RESOLVE_CONCURRENCY))
+
+async def _timed(handler, resolving):
+    """Awaits a resolver, recording its latency (slot wait included) and outcome per handler."""
+    started = time.perf_counter()
+    outcome = "exception"
+    try:
+        result = await resolving
+        outcome = "fallback" if result is None else "error" if "error" in result else "ok"
+        return result
+    finally:
+        RESOLVE_SECONDS.observe(time.perf_counter() - started, handler)
+        RESOLVES.inc(handler, outcome)
 
 class UniversalDownloader:
     @staticmethod
     async def resolve(url: str, cookie: str = None):
+        # Cached per canonical URL; concurrent identical requests share one resolution.
+        # Without a cookie, Terabox links are resolved with an account from the cookie pool.
+        return await RESOLVE_CACHE.get_or_resolve(
+            cache_key(url, cookie),
+            lambda: UniversalDownloader._resolve_uncached(url, cookie)
+        )
+
+    @staticmethod
+    async def refresh(url: str, stale_url: str = None, cookie: str = None):
+        """Resolves `url` again when its cached result still carries the rejected `stale_url`."""
+        RESOLVE_CACHE.invalidate(cache_key(url, cookie), stale_url)
+        return await UniversalDownloader.resolve(url, cookie)
+
+    @staticmethod
+    async def _resolve_uncached(url: str, cookie: str = None):
         # 1. Custom Handlers
-        if any(x in url for x in ["terabox", "1024tera", "terashare", "miracledown", "teraboxapp"]):
-            return await extract_terabox_url(url, cookie)
+        if is_terabox_url(url):
+            if cookie:
+                return await UniversalDownloader._resolve_terabox(url, cookie)
+            return await UniversalDownloader._resolve_with_pool(url)
             
         # 2. General Handler (yt-dlp)
-        return await UniversalDownloader._fetch_with_ytdlp(url)
+        return await _timed("ytdlp", UniversalDownloader._extract_with_ytdlp(url))
+
+    @staticmethod
+    async def _extract_with_ytdlp(url: str):
+        async with _ytdlp_slots:
+            return await UniversalDownloader._fetch_with_ytdlp(url)
+
+    @staticmethod
+    async def _resolve_terabox(url: str, cookie: str = None):
+        # Fast path: plain HTTP, browser only when challenged or data is missing
+        result = await _timed("terabox_http", resolve_terabox_http(url, cookie))
+        if result is not None:
+            return result
+        return await _timed("playwright", UniversalDownloader._extract_in_browser(url, cookie))
+
+    @staticmethod
+    async def _extract_in_browser(url: str, cookie: str = None):
+        async with _browser_slots:
+            return await extract_terabox_url(url, cookie)
+
+    @staticmethod
+    async def _resolve_with_pool(url: str):
+        for attempt in range(COOKIE_POOL_RETRIES + 1):
+            account = await COOKIE_POOL.acquire()
+            result = await UniversalDownloader._resolve_terabox(url, account.cookie if account else None)
+            # Logged out / throttled accounts are quarantined; try the next one
+            if not account or not await COOKIE_POOL.report(account, result):
+                return result
+        return result
 
     @staticmethod
     async def _fetch_with_ytdlp(url: str):
@@ -27,8 +98,8 @@ class UniversalDownloader:
         }
         
         try:
-            loop = asyncio.get_event_loop()
-            info = await loop.run_in_executor(None, lambda: UniversalDownloader._ytdlp_extract(url, ydl_opts))
+            # Runs in a warm yt-dlp worker process, off the event loop's GIL
+            info = await YTDLP_POOL.run("extract", url, ydl_opts, timeout=YTDLP_EXTRACT_TIMEOUT)
             
             formats = []
             seen_res = set()
@@ -88,24 +159,24 @@ class UniversalDownloader:
             return {"error": f"Supported site extraction failed: {str(e)}"}
 
     @staticmethod
-    def _ytdlp_extract(url, opts):
-        with yt_dlp.YoutubeDL(opts) as ydl:
-            return ydl.extract_info(url, download=False)
-
-    @staticmethod
-    async def process_download(url: str, format_id: str):
+    async def process_download(url: str, format_id: str, on_progress=None):
         """
         Downloads and merges the specific format with best audio.
         Returns the path to the local file.
+        `on_progress(event)` is called on the event loop with compact progress events.
         """
-        file_id = str(uuid.uuid4())
-        filename = f"{file_id}.mp4"
-        output_path = os.path.join(DOWNLOAD_DIR, filename)
+        format_selector = UniversalDownloader.format_selector(format_id)
+        file_id = UniversalDownloader.output_key(url, format_selector)
+
+        # Same item processed before: serve the finished output straight from disk
+        output_path, filename = UniversalDownloader.find_output(file_id)
+        if output_path:
+            print(f"Reusing processed output: {output_path}")
+            return output_path, filename
         
-        # Optimize: Request M4A audio to match MP4 video for instant merge (avoids re-encode)
         ydl_opts = {
-            'format': f'{format_id}+bestaudio[ext=m4a]/bestaudio',
-            'merge_output_format': 'mp4',
+            'format': format_selector,
+            'merge_output_format': OUTPUT_CONTAINER,
             'outtmpl': os.path.join(DOWNLOAD_DIR, f'{file_id}.%(ext)s'),
             'quiet': True,
             'no_warnings': True,
@@ -118,21 +189,38 @@ class UniversalDownloader:
         }
         
         try:
-            loop = asyncio.get_event_loop()
-            await loop.run_in_executor(None, lambda: UniversalDownloader._ytdlp_download(url, ydl_opts))
+            await YTDLP_POOL.run("download", url, ydl_opts, timeout=YTDLP_DOWNLOAD_TIMEOUT, on_progress=on_progress)
             
             # yt-dlp might have saved it as .mkv or other container if merge failed or wasn't needed
-            # Check for the file
-            for f in os.listdir(DOWNLOAD_DIR):
-                if f.startswith(file_id):
-                    return os.path.join(DOWNLOAD_DIR, f), f 
-            
-            return None, None
+            return UniversalDownloader.find_output(file_id)
         except Exception as e:
             print(f"Processing failed: {e}")
             return None, None
 
     @staticmethod
-    def _ytdlp_download(url, opts):
-        with yt_dlp.YoutubeDL(opts) as ydl:
-            ydl.download([url])
+    def format_selector(format_id: str):
+        # Optimize: Request M4A audio to match MP4 video for instant merge (avoids re-encode)
+        return f'{format_id}+bestaudio[ext=m4a]/bestaudio'
+
+    @staticmethod
+    def output_key(url: str, format_selector: str, container: str = OUTPUT_CONTAINER):
+        """
+        Stable file id for a processed output: hash of (canonical URL, format selector, container).
+        Repeat requests for the same item map onto the same file.
+        """
+        identity = f"{canonical_url(url)}\n{format_selector}\n{container}"
+        return hashlib.sha256(identity.encode()).hexdigest()[:32]
+
+    @staticmethod
+    def find_output(file_id: str):
+        """
+        Returns (path, filename) of the finished output for `file_id`, or (None, None).
+        yt-dlp only renames the merged file to `<id>.<ext>` once it is complete, so
+        intermediate `.part`/`.temp`/`.fNNN` files never match.
+        """
+        for ext in OUTPUT_EXTS:
+            filename = f"{file_id}.{ext}"
+            path = os.path.join(DOWNLOAD_DIR, filename)
+            if os.path.isfile(path) and os.path.getsize(path) > 0:
+                return path, filename
+        return None, None
@@ -0,0 +1,345 @@
+import asyncio
+import multiprocessing
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# yt-dlp worker pool tuning (overridable from the environment)
+YTDLP_WORKERS = int(os.environ.get("YTDLP_WORKERS", "4"))  # 0 runs yt-dlp on threads instead of processes
+YTDLP_QUEUE_SIZE = int(os.environ.get("YTDLP_QUEUE_SIZE", "100"))  # Tasks waiting for a worker
+YTDLP_EXTRACT_TIMEOUT = float(os.environ.get("YTDLP_EXTRACT_TIMEOUT", "120"))
+YTDLP_DOWNLOAD_TIMEOUT = float(os.environ.get("YTDLP_DOWNLOAD_TIMEOUT", "7200"))
+YTDLP_START_METHOD = os.environ.get("YTDLP_START_METHOD", "spawn")
+THREAD_FALLBACK_WORKERS = 4  # Concurrent tasks when running on threads
+WORKER_START_TIMEOUT = 60
+
+
+class PoolFullError(Exception):
+    pass
+
+
+class YtdlpTaskError(Exception):
+    """yt-dlp itself failed; the worker that ran the task is fine."""
+    pass
+
+
+# Tasks (run inside a worker process, or on a thread in fallback mode)
+
+def progress_hooks(on_progress, interval=0.5):
+    """
+    Translates yt-dlp download/postprocessor hooks into progress events.
+    Video and audio are downloaded as separate files, so bytes are summed per file.
+    Download events are throttled to one per `interval` seconds.
+    """
+    files = {}
+    state = {"last": 0.0}
+
+    def download_hook(d):
+        if d.get('status') not in ('downloading', 'finished'):
+            return
+        total = d.get('total_bytes') or d.get('total_bytes_estimate') or 0
+        files[d.get('filename')] = (d.get('downloaded_bytes') or 0, total)
+        now = time.monotonic()
+        if d['status'] == 'downloading' and now - state["last"] < interval:
+            return
+        state["last"] = now
+        on_progress({
+            "phase": "downloading",
+            "downloaded_bytes": sum(done for done, _ in files.values()),
+            "total_bytes": sum(size for _, size in files.values()),
+            "speed": d.get('speed'),
+            "eta": d.get('eta'),
+        })
+
+    def postprocessor_hook(d):
+        if d.get('status') == 'started' and d.get('postprocessor') in ('Merger', 'FFmpegMerger'):
+            on_progress({"phase": "merging", "speed": None, "eta": None})
+
+    return [download_hook], [postprocessor_hook]
+
+
+def extract_info(url, opts, on_progress=None):
+    import yt_dlp
+    with yt_dlp.YoutubeDL(opts) as ydl:
+        # Plain data only: the result crosses a process boundary
+        return ydl.sanitize_info(ydl.extract_info(url, download=False))
+
+
+def download(url, opts, on_progress=None):
+    import yt_dlp
+    if on_progress:
+        opts = dict(opts)
+        opts['progress_hooks'], opts['postprocessor_hooks'] = progress_hooks(on_progress)
+    with yt_dlp.YoutubeDL(opts) as ydl:
+        ydl.download([url])
+
+
+def import_extractors():
+    """Imports yt-dlp and its extractor classes, the slow part of a first extraction."""
+    from yt_dlp.extractor import gen_extractor_classes
+    return len(gen_extractor_classes())
+
+
+TASKS = {"extract": extract_info, "download": download}
+
+
+def _worker_main(conn):
+    import_extractors()  # Once per worker, ahead of the first task
+    conn.send(("ready", None))
+    while True:
+        try:
+            name, args, wants_progress = conn.recv()
+        except EOFError:
+            return
+        on_progress = (lambda event: conn.send(("progress", event))) if wants_progress else None
+        try:
+            conn.send(("result", TASKS[name](*args, on_progress=on_progress)))
+        except Exception as e:
+            conn.send(("error", str(e)))
+
+
+class _Worker:
+    def __init__(self, ctx):
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_worker_main, args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def wait_ready(self):
+        """Blocks until yt-dlp is imported in the worker."""
+        try:
+            if self.conn.poll(WORKER_START_TIMEOUT) and self.conn.recv()[0] == "ready":
+                return
+        except EOFError:
+            pass
+        raise RuntimeError(f"yt-dlp worker did not start (exit code {self.process.exitcode})")
+
+    def kill(self):
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join(5)
+        self.conn.close()
+
+
+class YtdlpPool:
+    """
+    Worker processes that keep yt-dlp imported, so extraction and downloads don't
+    compete with the event loop for the GIL. Tasks wait in a bounded queue; a task
+    that times out or is cancelled kills its worker, which is replaced in the
+    background. Where processes cannot be started, tasks run on threads instead
+    (timeouts then only stop the wait). Either way, a running task holds a thread of
+    the pool's own executor (waiting on its worker's pipe, or running yt-dlp), so
+    hours-long downloads never take threads from asyncio.to_thread callers.
+    """
+
+    def __init__(self, workers: int = YTDLP_WORKERS, max_queued: int = YTDLP_QUEUE_SIZE):
+        self.size = max(0, workers)
+        self.max_queued = max_queued
+        self.mode = None
+        self._ctx = None
+        self._workers = set()
+        self._idle = None
+        self._thread_slots = None
+        self._executor = None
+        self._lock = asyncio.Lock()
+        self._tasks = set()
+
+        # Stats
+        self.waiting = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.timeouts = 0
+        self.cancelled = 0
+        self.restarts = 0
+
+    @property
+    def started(self):
+        return self.mode is not None
+
+    async def start(self):
+        async with self._lock:
+            if self.started:
+                return
+            self._idle = asyncio.Queue()
+            if self.size:
+                try:
+                    self._ctx = multiprocessing.get_context(YTDLP_START_METHOD)
+                    for worker in await asyncio.gather(*(self._spawn() for _ in range(self.size))):
+                        self._idle.put_nowait(worker)
+                    self._executor = ThreadPoolExecutor(self.size, thread_name_prefix="ytdlp-pipe")
+                    self.mode = "process"
+                    print(f"yt-dlp pool started ({self.size} worker processes)")
+                    return
+                except Exception as e:
+                    print(f"yt-dlp pool: worker processes unavailable, using threads: {e}")
+                    for worker in list(self._workers):
+                        self._discard(worker)
+            slots = self.size or THREAD_FALLBACK_WORKERS
+            self._thread_slots = asyncio.Semaphore(slots)
+            self._executor = ThreadPoolExecutor(slots, thread_name_prefix="ytdlp")
+            self.mode = "thread"
+
+    async def warm(self):
+        """Starts the pool and makes sure yt-dlp's extractors are imported wherever tasks run."""
+        await self.start()
+        if self.mode == "thread":
+            await asyncio.to_thread(import_extractors)
+
+    @property
+    def ready(self):
+        return self.started and (self.mode == "thread" or self._idle.qsize() + self.running > 0)
+
+    async def stop(self):
+        async with self._lock:
+            for task in list(self._tasks):
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+            for worker in list(self._workers):
+                self._discard(worker)
+            self._idle = None
+            self._thread_slots = None
+            if self._executor:
+                # Threads of timed-out thread-mode tasks cannot be interrupted; don't wait for them
+                self._executor.shutdown(wait=False)
+                self._executor = None
+            self.mode = None
+
+    async def _spawn(self):
+        worker = await asyncio.to_thread(_Worker, self._ctx)
+        self._workers.add(worker)
+        try:
+            await asyncio.to_thread(worker.wait_ready)
+        except Exception:
+            self._discard(worker)
+            raise
+        return worker
+
+    def _discard(self, worker):
+        self._workers.discard(worker)
+        worker.kill()
+
+    async def _replace(self, worker, idle):
+        await asyncio.to_thread(self._discard, worker)
+        while self.started and idle is self._idle:
+            try:
+                idle.put_nowait(await self._spawn())
+                self.restarts += 1
+                return
+            except Exception as e:
+                print(f"yt-dlp pool: worker restart failed: {e}")
+                await asyncio.sleep(5)
+
+    def _schedule_replace(self, worker, idle):
+        task = asyncio.create_task(self._replace(worker, idle))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def run(self, task: str, *args, timeout: float, on_progress=None):
+        """
+        Runs TASKS[task](*args) and returns its result. `on_progress(event)` is called
+        on the event loop for download progress. Raises PoolFullError when the queue
+        is full, YtdlpTaskError when yt-dlp fails and asyncio.TimeoutError on timeout.
+        """
+        if self.waiting >= self.max_queued:
+            raise PoolFullError("yt-dlp queue is full, try again later")
+        if not self.started:
+            await self.start()
+
+        try:
+            if self.mode == "thread":
+                return await self._run_thread(task, args, timeout, on_progress)
+            return await self._run_process(task, args, timeout, on_progress)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        except Exception:
+            self.failed += 1
+            raise
+
+    async def _run_thread(self, task, args, timeout, on_progress):
+        loop = asyncio.get_running_loop()
+        # Hooks fire on the worker thread; deliver events on the loop like process mode does
+        forward = (lambda event: loop.call_soon_threadsafe(on_progress, event)) if on_progress else None
+        self.waiting += 1
+        try:
+            await self._thread_slots.acquire()
+        finally:
+            self.waiting -= 1
+        self.running += 1
+        try:
+            result = await asyncio.wait_for(
+                loop.run_in_executor(self._executor, lambda: TASKS[task](*args, on_progress=forward)), timeout)
+        except asyncio.TimeoutError:
+            raise
+        except Exception as e:
+            raise YtdlpTaskError(str(e)) from e
+        finally:
+            self.running -= 1
+            self._thread_slots.release()
+        self.completed += 1
+        return result
+
+    async def _run_process(self, task, args, timeout, on_progress):
+        idle = self._idle
+        self.waiting += 1
+        try:
+            worker = await idle.get()
+        finally:
+            self.waiting -= 1
+
+        self.running += 1
+        healthy = False
+        try:
+            result = await asyncio.wait_for(self._call(worker, task, args, on_progress), timeout)
+            healthy = True
+            self.completed += 1
+            return result
+        except YtdlpTaskError:
+            healthy = True
+            raise
+        finally:
+            self.running -= 1
+            if healthy:
+                idle.put_nowait(worker)
+            else:
+                # Timed out, cancelled or crashed: the worker may still be busy, replace it
+                self._schedule_replace(worker, idle)
+
+    async def _call(self, worker, task, args, on_progress):
+        loop = asyncio.get_running_loop()
+        worker.conn.send((task, args, on_progress is not None))
+        while True:
+            try:
+                kind, value = await loop.run_in_executor(self._executor, worker.conn.recv)
+            except (EOFError, OSError):
+                raise RuntimeError(f"yt-dlp worker exited (code {worker.process.exitcode})")
+            if kind == "progress":
+                if on_progress:
+                    on_progress(value)
+            elif kind == "result":
+                return value
+            else:
+                raise YtdlpTaskError(value)
+
+    def stats(self):
+        return {
+            "mode": self.mode,
+            "workers": sum(1 for w in self._workers if w.process.is_alive()),
+            "idle": self._idle.qsize() if self._idle else 0,
+            "waiting": self.waiting,
+            "max_queued": self.max_queued,
+            "running": self.running,
+            "completed": self.completed,
+            "failed": self.failed,
+            "timeouts": self.timeouts,
+            "cancelled": self.cancelled,
+            "restarts": self.restarts,
+        }
+
+
+# Shared pool, started/stopped by the FastAPI app lifespan
+YTDLP_POOL = YtdlpPool()
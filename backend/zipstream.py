@@ -0,0 +1,119 @@
+import struct
+import time
+import zlib
+
+# Every member is written as ZIP64 with a trailing data descriptor: the archive can be
+# produced in one pass (CRCs are only known after a member is sent) and its exact size
+# is known upfront whenever the member sizes are.
+ZIP64_MARKER = 0xFFFFFFFF
+VERSION = 45  # 4.5: ZIP64
+FLAGS = 0x0008 | 0x0800  # Data descriptor follows the data; UTF-8 names
+
+LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+LOCAL_ZIP64_EXTRA = struct.Struct("<HHQQ")
+DATA_DESCRIPTOR = struct.Struct("<IIQQ")
+CENTRAL_HEADER = struct.Struct("<IHHHHHHIIIHHHHHII")
+CENTRAL_ZIP64_EXTRA = struct.Struct("<HHQQQ")
+ZIP64_END = struct.Struct("<IQHHIIQQQQ")
+ZIP64_LOCATOR = struct.Struct("<IIQI")
+END = struct.Struct("<IHHHHIIH")
+
+
+class ZipSizeError(Exception):
+    pass
+
+
+class ZipMember:
+    """
+    One archive member. `open_body()` returns an async iterator of its bytes;
+    `size` is None when unknown until the body has been sent.
+    """
+    __slots__ = ("name", "size", "open_body")
+
+    def __init__(self, name, size, open_body):
+        self.name = name
+        self.size = size
+        self.open_body = open_body
+
+
+def unique_names(names):
+    """Makes archive names unique: a.mp4, a (1).mp4, ..."""
+    seen = set()
+    result = []
+    for name in names:
+        name = name.replace("\\", "_").lstrip("/") or "file"
+        candidate, n = name, 1
+        stem, dot, ext = name.rpartition(".")
+        if not dot:
+            stem, ext = name, ""
+        while candidate in seen:
+            candidate = f"{stem} ({n}){dot}{ext}"
+            n += 1
+        seen.add(candidate)
+        result.append(candidate)
+    return result
+
+
+def zip_size(members):
+    """Exact archive size, or None when any member size is unknown."""
+    if any(m.size is None for m in members):
+        return None
+    total = ZIP64_END.size + ZIP64_LOCATOR.size + END.size
+    for m in members:
+        name = len(m.name.encode("utf-8"))
+        total += LOCAL_HEADER.size + name + LOCAL_ZIP64_EXTRA.size + m.size + DATA_DESCRIPTOR.size
+        total += CENTRAL_HEADER.size + name + CENTRAL_ZIP64_EXTRA.size
+    return total
+
+
+def _dos_time(ts):
+    t = time.localtime(ts)
+    return ((t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+            ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday)
+
+
+async def stream_zip(members):
+    """
+    Yields a stored (uncompressed) ZIP64 archive of `members`, one member body at a
+    time; nothing is buffered beyond the chunk in flight. Raises ZipSizeError when a
+    member's body does not match its declared size (the archive would be corrupt).
+    """
+    dos_time, dos_date = _dos_time(time.time())
+    offset = 0
+    central = []
+
+    for m in members:
+        name = m.name.encode("utf-8")
+        header = LOCAL_HEADER.pack(0x04034B50, VERSION, FLAGS, 0, dos_time, dos_date, 0,
+                                   ZIP64_MARKER, ZIP64_MARKER, len(name), LOCAL_ZIP64_EXTRA.size)
+        header += name + LOCAL_ZIP64_EXTRA.pack(0x0001, 16, 0, 0)
+        yield header
+
+        crc = 0
+        size = 0
+        async for chunk in m.open_body():
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            yield chunk
+        if m.size is not None and size != m.size:
+            raise ZipSizeError(f"{m.name}: expected {m.size} bytes, got {size}")
+
+        yield DATA_DESCRIPTOR.pack(0x08074B50, crc, size, size)
+
+        central.append(
+            CENTRAL_HEADER.pack(0x02014B50, VERSION, VERSION, FLAGS, 0, dos_time, dos_date, crc,
+                                ZIP64_MARKER, ZIP64_MARKER, len(name), CENTRAL_ZIP64_EXTRA.size, 0, 0, 0, 0,
+                                ZIP64_MARKER)
+            + name + CENTRAL_ZIP64_EXTRA.pack(0x0001, 24, size, size, offset)
+        )
+        offset += len(header) + size + DATA_DESCRIPTOR.size
+
+    directory = b"".join(central)
+    zip64_end_offset = offset + len(directory)
+    yield (
+        directory
+        + ZIP64_END.pack(0x06064B50, ZIP64_END.size - 12, VERSION, VERSION, 0, 0,
+                         len(central), len(central), len(directory), offset)
+        + ZIP64_LOCATOR.pack(0x07064B50, 0, zip64_end_offset, 1)
+        + END.pack(0x06054B50, 0, 0, 0xFFFF, 0xFFFF, ZIP64_MARKER, ZIP64_MARKER, 0)
+    )
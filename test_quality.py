@@ -34,7 +34,7 @@ def test_quality_flow():
         return
 
     print(f"\n2. Testing Processing for {processed_fmt['label']}...")
-    print("Sending process request (this might take time)...")
+    print("Sending process request...")
     
     start_time = time.time()
     proc_resp = requests.post(f"{BASE_URL}/api/process", json={
@@ -46,7 +46,21 @@ def test_quality_flow():
         print(f"Processing failed: {proc_resp.text}")
         return
         
-    proc_data = proc_resp.json()
+    job = proc_resp.json()
+    print(f"Job queued: {job.get('jobId')}")
+
+    # Processing runs in the background; poll the job until it is done
+    while True:
+        proc_data = requests.get(f"{BASE_URL}/api/jobs/{job['jobId']}").json()
+        if proc_data.get("status") in ("finished", "error"):
+            break
+        print(f" - {proc_data.get('status')} {proc_data.get('progress')}%")
+        time.sleep(2)
+
+    if proc_data.get("status") != "finished":
+        print(f"Processing failed: {proc_data.get('error')}")
+        return
+
     print(f"Processing Complete in {time.time() - start_time:.2f}s!")
     print(f"File ID: {proc_data.get('fileId')}")
     